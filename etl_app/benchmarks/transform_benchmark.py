@@ -0,0 +1,117 @@
+"""
+Микробенчмарк этапа трансформации: сколько строк в секунду превращает в документы метод serialize
+каждой стратегии при валидации pydantic (ETL_STRICT_VALIDATION=True) и через скомпилированный сериализатор.
+
+Строки имеют тот же вид, что отдают запросы стратегий: агрегированные участники фильма приходят
+сырым списком persons и раскладываются по полям документа в serialize.
+
+Запуск из каталога etl_app: python -m benchmarks.transform_benchmark [число строк]
+"""
+import datetime
+import sys
+import time
+import uuid
+from typing import Callable, List, Type
+
+from transfer.strategy import (ContentTableStrategyFabric,
+                               FilmWorkTableStrategyFabric,
+                               GenreTableStrategyFabric,
+                               GenreTableStrategyGenreIndexFabric,
+                               MovieTableStrategyFabric,
+                               PersonTableStrategyFabric,
+                               PersonTableStrategyPersonIndexFabric)
+
+
+def persons() -> List[dict]:
+    return [
+        {'person_role': 'director', 'person_id': str(uuid.uuid4()), 'person_name': 'Director'},
+        {'person_role': 'actor', 'person_id': str(uuid.uuid4()), 'person_name': 'Actor 1'},
+        {'person_role': 'actor', 'person_id': str(uuid.uuid4()), 'person_name': 'Actor 2'},
+        {'person_role': 'writer', 'person_id': str(uuid.uuid4()), 'person_name': 'Writer'},
+    ]
+
+
+def film_rows(count: int) -> List[dict]:
+    return [
+        {
+            'id': str(uuid.uuid4()),
+            'imdb_rating': 7.5,
+            'title': f'Film {i}',
+            'description': 'Some description',
+            'modified': datetime.datetime.now(),
+        }
+        for i in range(count)
+    ]
+
+
+def genre_rows(count: int) -> List[dict]:
+    return [{'id': str(uuid.uuid4()), 'genre': ['Action', 'Drama', 'Comedy']} for _ in range(count)]
+
+
+def person_rows(count: int) -> List[dict]:
+    return [{'id': str(uuid.uuid4()), 'persons': persons()} for _ in range(count)]
+
+
+def movie_rows(count: int) -> List[dict]:
+    return [
+        {
+            'id': str(uuid.uuid4()),
+            'imdb_rating': 7.5,
+            'title': f'Film {i}',
+            'description': 'Some description',
+            'genre': ['Action', 'Drama'],
+            'persons': persons(),
+        }
+        for i in range(count)
+    ]
+
+
+def genre_index_rows(count: int) -> List[dict]:
+    return [
+        {
+            'id': str(uuid.uuid4()),
+            'name': f'Genre {i}',
+            'description': None if i % 2 else 'Some description',
+            'modified': datetime.datetime.now(),
+        }
+        for i in range(count)
+    ]
+
+
+def person_index_rows(count: int) -> List[dict]:
+    return [
+        {'id': str(uuid.uuid4()), 'full_name': f'Person {i}', 'modified': datetime.datetime.now()}
+        for i in range(count)
+    ]
+
+
+def rows_per_sec(func: Callable[[dict], dict], rows: List[dict]) -> float:
+    started = time.perf_counter()
+    for row in rows:
+        func(row)
+    return len(rows) / (time.perf_counter() - started)
+
+
+def serialize_rate(strategy: Type[ContentTableStrategyFabric], rows: List[dict], strict: bool) -> float:
+    table = strategy(strict_validation=strict)
+    return rows_per_sec(table.serialize, rows)
+
+
+def main(count: int):
+    cases = [
+        ('film_work', FilmWorkTableStrategyFabric, film_rows(count)),
+        ('genre -> movies', GenreTableStrategyFabric, genre_rows(count)),
+        ('person -> movies', PersonTableStrategyFabric, person_rows(count)),
+        ('movie', MovieTableStrategyFabric, movie_rows(count)),
+        ('genre -> genres', GenreTableStrategyGenreIndexFabric, genre_index_rows(count)),
+        ('person -> persons', PersonTableStrategyPersonIndexFabric, person_index_rows(count)),
+    ]
+    print(f'{"strategy":<20}{"strict rows/s":>16}{"fast rows/s":>16}{"speedup":>10}')
+    for name, strategy, rows in cases:
+        strict = serialize_rate(strategy, rows, strict=True)
+        fast = serialize_rate(strategy, rows, strict=False)
+        print(f'{name:<20}{strict:>16.0f}{fast:>16.0f}{fast / strict:>9.1f}x')
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 50000)
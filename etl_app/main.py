@@ -2,11 +2,17 @@ import datetime
 import os
 
 from psycopg2.extras import RealDictCursor
-from transfer.manager import Manager
-from transfer.settings import Settings
+from transfer import hashes, postgres, transform_pool
+from transfer.backfill import Backfill
+from transfer.listener import ChangeListener
+from transfer.postgres import PostgresPool
+from transfer.rebuild import Rebuild
+from transfer.scheduler import Scheduler, Worker
+from transfer.settings import EtlMode, HashStorage, Settings, StateStorage
+from transfer.transform_pool import TransformPool
+from transfer.watermarks import ensure_modified_indexes
 
 if __name__ == '__main__':
-    m = Manager()
     # промежуток времени
     # ограничение размера запроса в postgres
     settings = Settings(
@@ -17,24 +23,74 @@ if __name__ == '__main__':
         host=os.environ.get('DB_HOST', '127.0.0.1'),
         port=os.environ.get('DB_PORT', 5432),
         cursor_factory=RealDictCursor,
-        date_end=datetime.datetime.now()
+        date_end=datetime.datetime.now(),
+        pool_min_size=int(os.environ.get('DB_POOL_MIN_SIZE', 1)),
+        pool_max_size=int(os.environ.get('DB_POOL_MAX_SIZE', 5)),
+        pool_check_interval=int(os.environ.get('DB_POOL_CHECK_INTERVAL', 30)),
+        mode=EtlMode(os.environ.get('ETL_MODE', EtlMode.batch)),
+        itersize=int(os.environ.get('ETL_ITERSIZE', 2000)),
+        pipeline_queue_size=int(os.environ.get('ETL_PIPELINE_QUEUE_SIZE', 2)),
+        transform_workers=int(os.environ.get('ETL_TRANSFORM_WORKERS', 0)),
+        transform_chunk_size=int(os.environ.get('ETL_TRANSFORM_CHUNK_SIZE', 500)),
+        backfill_threshold=int(os.environ.get('ETL_BACKFILL_THRESHOLD', 3600)),
+        parallel=os.environ.get('ETL_PARALLEL', 'False') == 'True',
+        poll_min_interval=float(os.environ.get('ETL_POLL_MIN_INTERVAL', 1)),
+        poll_max_interval=float(os.environ.get('ETL_POLL_MAX_INTERVAL', 30)),
+        listen=os.environ.get('ETL_LISTEN', 'False') == 'True',
+        backfill=os.environ.get('ETL_BACKFILL', 'False') == 'True',
+        backfill_partitions=int(os.environ.get('ETL_BACKFILL_PARTITIONS', 16)),
+        backfill_workers=int(os.environ.get('ETL_BACKFILL_WORKERS', 4)),
+        create_indexes=os.environ.get('ETL_CREATE_INDEXES', 'False') == 'True',
+        rebuild=os.environ.get('ETL_REBUILD', 'False') == 'True',
+        merge_movies=os.environ.get('ETL_MERGE_MOVIES', 'False') == 'True',
+        raw_json=os.environ.get('ETL_RAW_JSON', 'False') == 'True',
+        strict_validation=os.environ.get('ETL_STRICT_VALIDATION', 'False') == 'True',
+        state_storage=StateStorage(os.environ.get('ETL_STATE_STORAGE', StateStorage.json)),
+        state_file_path=os.environ.get('ETL_STATE_FILE', 'state.json'),
+        skip_unchanged=os.environ.get('ETL_SKIP_UNCHANGED', 'False') == 'True',
+        hash_storage=HashStorage(os.environ.get('ETL_HASH_STORAGE', HashStorage.file)),
+        hash_file_path=os.environ.get('ETL_HASH_FILE', 'hashes.db'),
+        redis_host=os.environ.get('REDIS_HOST', '127.0.0.1'),
+        redis_port=int(os.environ.get('REDIS_PORT', 6379)),
+    )
+    # один пул процессов трансформации на все стратегии; процессы порождаются до запуска потоков
+    if settings.transform_workers:
+        transform_pool.pool = TransformPool(
+            workers=settings.transform_workers,
+            chunk_size=settings.transform_chunk_size
+        )
+
+    # один пул соединений на все стратегии и служебные запросы
+    postgres.pool = PostgresPool(
+        minconn=settings.pool_min_size,
+        maxconn=settings.pool_max_size,
+        check_interval=settings.pool_check_interval,
+        **settings.dsn
     )
 
-    # самое старое обновление
-    settings.date_start = settings.get_the_earliest_update()
+    # хэши отправленных документов: неизмененные документы не отправляются повторно
+    hashes.store = settings.get_hash_store()
 
-    counter = 0
-    while True:
+    # индексы по modified, без которых каждое окно читает таблицы целиком
+    ensure_modified_indexes(create=settings.create_indexes)
 
-        is_done_table, is_done_time = m.start(
-            reference_date_start=settings.date_start,
-            reference_date_end=settings.date_end,
-            query_limit=settings.qs_limit,
-            offset=settings.qs_limit * counter
-        )
+    if settings.rebuild:
+        # индексы перестраиваются целиком, сервисы до переключения алиасов читают прежние версии
+        Rebuild(settings).run()
+    elif settings.backfill:
+        # пустой кластер заполняется параллельно по диапазонам id, прогресс диапазонов сохраняется в state
+        Backfill(settings).run()
+    else:
+        if settings.listen:
+            # триггеры, которые сообщают воркерам id измененных строк
+            ChangeListener.install()
 
-        if is_done_time:
-            settings.date_start = settings.date_end
-            settings.date_end = datetime.datetime.now()
+        # прогресс стратегий: после перезапуска загрузка продолжается с места остановки
+        state = settings.get_state()
 
-        counter = 0 if is_done_table else counter + 1
+        if settings.parallel:
+            # каждая стратегия в своем потоке со своим окном
+            Scheduler(settings, state=state).run()
+        else:
+            # стратегии по очереди в общем окне
+            Worker(settings, state=state).run()
@@ -0,0 +1,135 @@
+import datetime
+import json
+import logging
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional, Sequence, Tuple, Type
+
+from pydantic import BaseModel
+
+from .elastic import BulkError, BulkStats
+from .manager import Manager
+from .settings import Settings
+from .state import State
+from .strategy import ContentTableStrategyFabric
+from .validators import Watermark
+
+# ключ, под которым хранятся момент начала загрузки и число диапазонов
+STARTED_KEY = 'backfill:started'
+
+
+class RangeCheckpoint(BaseModel):
+    """Прогресс загрузки одного диапазона id: [lower, upper), загружено до position включительно"""
+    lower: uuid.UUID
+    upper: Optional[uuid.UUID]
+    position: Optional[uuid.UUID]
+    done: bool = False
+    rows: int = 0
+
+
+def partitions(count: int) -> List[Tuple[uuid.UUID, Optional[uuid.UUID]]]:
+    """Равные диапазоны пространства UUID; случайные uuid4 распределяются по ним равномерно"""
+    bounds = [uuid.UUID(int=i * 2 ** 128 // count) for i in range(count)]
+    return list(zip(bounds, bounds[1:] + [None]))
+
+
+class Backfill:
+    """
+    Начальная загрузка пустого кластера: каждая таблица делится на диапазоны id, и диапазоны
+    загружаются параллельно, каждый своими запросами к БД и своими bulk-запросами.
+
+    Прогресс каждого диапазона сохраняется после каждой страницы, поэтому прерванная загрузка
+    продолжается с места остановки. После загрузки синхронизация продолжается с момента ее начала.
+    """
+
+    def __init__(
+            self,
+            settings: Settings,
+            chain: Optional[Sequence[Type[ContentTableStrategyFabric]]] = None,
+            state: Optional[State] = None
+    ):
+        self.chain = tuple(chain or Manager.chain_for(settings))
+        self.state = state or settings.get_state()
+        self.partitions = settings.backfill_partitions
+        self.workers = settings.backfill_workers
+        self.query_limit = settings.qs_limit
+        self.strategy_options = dict(raw_json=settings.raw_json, strict_validation=settings.strict_validation)
+
+    @staticmethod
+    def key(strategy: Type[ContentTableStrategyFabric], partition: int) -> str:
+        return f'backfill:{strategy.__name__}:{partition}'
+
+    def checkpoints(self, strategy: Type[ContentTableStrategyFabric]) -> List[Tuple[str, RangeCheckpoint]]:
+        checkpoints = []
+        for partition, (lower, upper) in enumerate(partitions(self.partitions)):
+            key = self.key(strategy, partition)
+            raw = self.state.get_state(key)
+            checkpoint = RangeCheckpoint.parse_obj(raw) if raw else RangeCheckpoint(lower=lower, upper=upper)
+            checkpoints.append((key, checkpoint))
+        return checkpoints
+
+    def save(self, key: str, checkpoint: RangeCheckpoint):
+        self.state.set_state(key, json.loads(checkpoint.json()))
+
+    def load_range(self, strategy: Type[ContentTableStrategyFabric], key: str, checkpoint: RangeCheckpoint):
+        table = strategy(**self.strategy_options)
+        stats = BulkStats()
+        started = time.monotonic()
+        while not checkpoint.done:
+            ids = table.range_ids(
+                lower=checkpoint.lower,
+                upper=checkpoint.upper,
+                position=checkpoint.position,
+                query_limit=self.query_limit
+            )
+            if ids:
+                qs = table.extract_ids(ids)
+                # кластер пуст, а хэши могли остаться от прежних загрузок: отправляются все документы
+                page = table.load(qs=table.transform(qs), skip_unchanged=False)
+                stats.merge(page)
+                if page.failed:
+                    # диапазон продолжится с последней полностью загруженной страницы
+                    raise BulkError(page)
+                checkpoint.position = uuid.UUID(ids[-1])
+                checkpoint.rows += len(ids)
+            checkpoint.done = len(ids) < self.query_limit
+            self.save(key, checkpoint)
+        stats.took_ms = int((time.monotonic() - started) * 1000)
+        logging.info('%s -> %s backfill %s: %s', table.table_name, table.es_index, key, stats)
+
+    def run(self):
+        resume = self.state.get_state(STARTED_KEY)
+        if resume is None:
+            # изменения, сделанные во время загрузки, подхватит синхронизация, начав с этого момента
+            resume = {'started': datetime.datetime.now().isoformat(), 'partitions': self.partitions}
+            self.state.set_state(STARTED_KEY, resume)
+        started = datetime.datetime.fromisoformat(resume['started'])
+        # прерванная загрузка продолжается с теми же границами диапазонов
+        self.partitions = resume['partitions']
+
+        tasks = [
+            (strategy, key, checkpoint)
+            for strategy in self.chain
+            for key, checkpoint in self.checkpoints(strategy)
+            if not checkpoint.done
+        ]
+        logging.info('backfill: %s ranges left in %s workers', len(tasks), self.workers)
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='etl-backfill') as executor:
+            futures = [executor.submit(self.load_range, *task) for task in tasks]
+            try:
+                for future in futures:
+                    future.result()
+            except BaseException:
+                # диапазоны, которые еще не начаты, подождут следующего запуска
+                for future in futures:
+                    future.cancel()
+                raise
+
+        for strategy in self.chain:
+            watermark = Watermark(date_start=started, position=None)
+            self.state.set_state(strategy.__name__, json.loads(watermark.json()))
+            for partition in range(self.partitions):
+                self.state.set_state(self.key(strategy, partition), None)
+        self.state.set_state(STARTED_KEY, None)
+        logging.info('backfill done, sync continues from %s', started)
@@ -1,20 +1,103 @@
+import datetime
+import json
+import logging
 import os
-from typing import Iterator
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+from typing import (Callable, Dict, Generator, Iterable, Iterator, List,
+                    Optional, Tuple)
 
 from elasticsearch import Elasticsearch, helpers
+from pydantic import BaseModel
+
+
+class BulkStats(BaseModel):
+    """Итог загрузки пачки документов"""
+    indexed: int = 0
+    failed: int = 0
+    # документы, удаленные вместе со строками БД
+    deleted: int = 0
+    took_ms: int = 0
+    # документы, не отправленные, потому что их содержимое не изменилось
+    skipped: int = 0
+    # загрузка шла с профилем догоняющей загрузки
+    backfill: bool = False
+
+    def merge(self, other: 'BulkStats'):
+        self.indexed += other.indexed
+        self.failed += other.failed
+        self.deleted += other.deleted
+        self.skipped += other.skipped
+
+    @property
+    def docs_per_sec(self) -> float:
+        return self.indexed * 1000 / self.took_ms if self.took_ms else 0
+
+    def __str__(self):
+        return (
+            f'indexed {self.indexed}, failed {self.failed}, {self.took_ms} ms, {self.docs_per_sec:.0f} docs/s'
+            + (f', deleted {self.deleted}' if self.deleted else '')
+            + (f', skipped {self.skipped}' if self.skipped else '')
+            + (', backfill' if self.backfill else '')
+        )
+
+
+class BulkError(Exception):
+    """Часть документов не записана в индекс: прогресс не сохраняется, и пачка загружается повторно"""
+
+    def __init__(self, stats: BulkStats):
+        super().__init__(f'{stats.failed} documents failed to load')
+        self.stats = stats
 
 
 class EsManagement:
     def __init__(self):
+        # 1 - последовательная загрузка, больше - параллельные bulk-запросы из пула потоков
+        self.bulk_threads = int(os.environ.get('ES_BULK_THREADS', 1))
+        # сколько пачек может ждать отправки, прежде чем чтение из БД приостановится
+        self.bulk_queue_size = int(os.environ.get('ES_BULK_QUEUE_SIZE', self.bulk_threads * 2))
+        # общий для всех стратегий предел одновременных bulk-запросов к кластеру
+        self.max_concurrency = int(os.environ.get('ES_MAX_CONCURRENCY', max(self.bulk_threads, 2)))
+        self.bulk_slots = threading.BoundedSemaphore(self.max_concurrency)
 
-        self.es_client = Elasticsearch(hosts=[f'http://{os.environ.get("ELASTICSEARCH_HOST", "localhost")}:9200'], )
+        self.es_client = Elasticsearch(
+            hosts=[f'http://{os.environ.get("ELASTICSEARCH_HOST", "localhost")}:9200'],
+            maxsize=max(self.max_concurrency, 10)
+        )
         self.index = 'movies'
+        # ограничения одного bulk-запроса: по числу документов и по размеру тела
+        self.chunk_size = int(os.environ.get('ES_BULK_CHUNK_SIZE', 500))
+        self.max_chunk_bytes = int(os.environ.get('ES_BULK_MAX_CHUNK_BYTES', 100 * 1024 * 1024))
+        # повторы документов, отклоненных с 429 (переполнена очередь записи)
+        self.max_retries = int(os.environ.get('ES_BULK_MAX_RETRIES', 3))
+        self.number_of_replicas = int(os.environ.get('ES_NUMBER_OF_REPLICAS', 1))
+        # алиас -> версия индекса, в которую идет запись во время перестройки
+        self.targets: Dict[str, str] = {}
+        # профиль догоняющей загрузки: реже обновление поиска, асинхронный translog, крупнее пачки
+        self.backfill_refresh_interval = os.environ.get('ES_BACKFILL_REFRESH_INTERVAL', '30s')
+        self.backfill_chunk_size = int(os.environ.get('ES_BACKFILL_CHUNK_SIZE', self.chunk_size * 4))
+        # алиас -> сколько воркеров сейчас догоняют в него
+        self.backfill: Dict[str, int] = {}
+        self.backfill_lock = threading.Lock()
         self.__set_indexes()
 
     def __set_indexes(self):
+        """
+        Сервисы и ETL обращаются к индексам по алиасам movies, genres и persons;
+        за каждым алиасом стоит версия индекса, которую можно перестроить и подменить без простоя
+        """
+        for alias, mapping in self.mappings().items():
+            if not self.es_client.indices.exists(index=alias):
+                self.create_index(index_name=self.versioned(alias), mapping=mapping, alias=alias)
+
+    def mappings(self) -> Dict[str, dict]:
         settings = {
             "settings": {
                 "refresh_interval": "1s",
+                "number_of_replicas": self.number_of_replicas,
                 "analysis": {
                     "filter": {
                         "english_stop": {
@@ -54,135 +137,442 @@ class EsManagement:
                 }
             }
         }
-        if not self.es_client.indices.exists(index=self.index):
-            self.create_index(
-                index_name=self.index,
-                mapping={
-                    **settings,
-                    "mappings": {
-                        "dynamic": "strict",
-                        "properties": {
-                            "id": {
-                                "type": "keyword"
-                            },
-                            "imdb_rating": {
-                                "type": "float"
-                            },
-                            "genre": {
-                                "type": "keyword"
-                            },
-                            "title": {
-                                "type": "text",
-                                "analyzer": "ru_en",
-                                "fields": {
-                                    "raw": {
-                                        "type": "keyword"
-                                    }
+        return {
+            self.index: {
+                **settings,
+                "mappings": {
+                    "dynamic": "strict",
+                    "properties": {
+                        "id": {
+                            "type": "keyword"
+                        },
+                        "imdb_rating": {
+                            "type": "float"
+                        },
+                        "genre": {
+                            "type": "keyword"
+                        },
+                        "title": {
+                            "type": "text",
+                            "analyzer": "ru_en",
+                            "fields": {
+                                "raw": {
+                                    "type": "keyword"
                                 }
-                            },
-                            "description": {
-                                "type": "text",
-                                "analyzer": "ru_en"
-                            },
-                            "director": {
-                                "type": "text",
-                                "analyzer": "ru_en"
-                            },
-                            "actors_names": {
-                                "type": "text",
-                                "analyzer": "ru_en"
-                            },
-                            "writers_names": {
-                                "type": "text",
-                                "analyzer": "ru_en"
-                            },
-                            "actors": {
-                                "type": "nested",
-                                "dynamic": "strict",
-                                "properties": {
-                                    "id": {
-                                        "type": "keyword"
-                                    },
-                                    "name": {
-                                        "type": "text",
-                                        "analyzer": "ru_en"
-                                    }
+                            }
+                        },
+                        "description": {
+                            "type": "text",
+                            "analyzer": "ru_en"
+                        },
+                        "director": {
+                            "type": "text",
+                            "analyzer": "ru_en"
+                        },
+                        "actors_names": {
+                            "type": "text",
+                            "analyzer": "ru_en"
+                        },
+                        "writers_names": {
+                            "type": "text",
+                            "analyzer": "ru_en"
+                        },
+                        "actors": {
+                            "type": "nested",
+                            "dynamic": "strict",
+                            "properties": {
+                                "id": {
+                                    "type": "keyword"
+                                },
+                                "name": {
+                                    "type": "text",
+                                    "analyzer": "ru_en"
                                 }
-                            },
-                            "writers": {
-                                "type": "nested",
-                                "dynamic": "strict",
-                                "properties": {
-                                    "id": {
-                                        "type": "keyword"
-                                    },
-                                    "name": {
-                                        "type": "text",
-                                        "analyzer": "ru_en"
-                                    }
+                            }
+                        },
+                        "writers": {
+                            "type": "nested",
+                            "dynamic": "strict",
+                            "properties": {
+                                "id": {
+                                    "type": "keyword"
+                                },
+                                "name": {
+                                    "type": "text",
+                                    "analyzer": "ru_en"
                                 }
                             }
                         }
                     }
                 }
-            )
-        if not self.es_client.indices.exists(index='genres'):
-            self.create_index(
-                index_name='genres',
-                mapping={
-                    **settings,
-                    "mappings": {
-                        "dynamic": "strict",
-                        "properties": {
-                            "id": {
-                                "type": "keyword"
-                            },
-                            "name": {
-                                "type": "keyword"
-                            },
-                            "description": {
-                                "type": "text"
-                            }
+            },
+            'genres': {
+                **settings,
+                "mappings": {
+                    "dynamic": "strict",
+                    "properties": {
+                        "id": {
+                            "type": "keyword"
+                        },
+                        "name": {
+                            "type": "keyword"
+                        },
+                        "description": {
+                            "type": "text"
                         }
                     }
                 }
-            )
-        if not self.es_client.indices.exists(index='persons'):
-            self.create_index(
-                index_name='persons',
-                mapping={
-                    **settings,
-                    "mappings": {
-                        "dynamic": "strict",
-                        "properties": {
-                            "id": {
-                                "type": "keyword"
-                            },
-                            "full_name": {
-                                "type": "keyword"
-                            },
-                            "birth_date": {
-                                "type": "dates"
-                            }
+            },
+            'persons': {
+                **settings,
+                "mappings": {
+                    "dynamic": "strict",
+                    "properties": {
+                        "id": {
+                            "type": "keyword"
+                        },
+                        "full_name": {
+                            "type": "keyword"
+                        },
+                        "birth_date": {
+                            "type": "dates"
                         }
                     }
                 }
-            )
+            }
+        }
 
-    def create_index(self, index_name: str, mapping: dict):
-        if not self.es_client.indices.exists(index=index_name):
-            self.es_client.indices.create(index=index_name, body=mapping)
+    def create_index(self, index_name: str, mapping: dict, alias: Optional[str] = None, exist_ok: bool = True):
+        """Без exist_ok уже существующий индекс - ошибка, а не молча пропущенное создание"""
+        if exist_ok and self.es_client.indices.exists(index=index_name):
+            return
+        body = {**mapping, "aliases": {alias: {}}} if alias else mapping
+        self.es_client.indices.create(index=index_name, body=body)
+
+    def physical_index(self, alias: str) -> str:
+        """Версия индекса, на которую сейчас указывает алиас; для индекса без алиаса - он сам"""
+        return next(iter(self.es_client.indices.get_alias(index=alias)))
+
+    @staticmethod
+    def versioned(alias: str) -> str:
+        # версии, созданные в одну секунду (при старте и сразу за ним при перестройке), различаются суффиксом
+        return f'{alias}_{datetime.datetime.now():%Y%m%d%H%M%S}_{uuid.uuid4().hex[:8]}'
+
+    def put_profile(self, alias: str, backfill: bool):
+        if backfill:
+            settings = {"refresh_interval": self.backfill_refresh_interval, "translog": {"durability": "async"}}
+        else:
+            settings = {
+                "refresh_interval": self.mappings()[alias]["settings"]["refresh_interval"],
+                "translog": {"durability": "request"}
+            }
+        self.es_client.indices.put_settings(index=alias, body={"index": settings})
 
-    def upsert(self, index, query_set: Iterator[dict]):
-        actions = []
+    def begin_backfill(self, alias: str):
+        """
+        Профиль догоняющей загрузки для алиаса: ETL сильно отстал, и скорость записи важнее свежести поиска.
+        Несколько воркеров могут догонять в один алиас: профиль включается первым и снимается последним.
+        """
+        with self.backfill_lock:
+            self.backfill[alias] = self.backfill.get(alias, 0) + 1
+            if self.backfill[alias] == 1:
+                self.put_profile(alias, backfill=True)
+                logging.info('%s: backfill profile on', alias)
+
+    def end_backfill(self, alias: str):
+        with self.backfill_lock:
+            if not self.backfill.get(alias):
+                return
+            self.backfill[alias] -= 1
+            if not self.backfill[alias]:
+                del self.backfill[alias]
+                self.put_profile(alias, backfill=False)
+                logging.info('%s: backfill profile off', alias)
+
+    def chunk_size_for(self, index: str) -> int:
+        return self.backfill_chunk_size if index in self.backfill else self.chunk_size
+
+    def begin_rebuild(self, alias: str) -> str:
+        """
+        Новая версия индекса для полной перестройки. Пока алиас указывает на старую версию, поиск
+        не обновляется и реплик нет: запись идет с полной скоростью, а загрузка стратегий уходит в новую версию.
+        """
+        mapping = self.mappings()[alias]
+        index = self.versioned(alias)
+        self.create_index(
+            index_name=index,
+            mapping={
+                **mapping,
+                "settings": {**mapping["settings"], "refresh_interval": "-1", "number_of_replicas": 0}
+            },
+            # запись в уже существующий, возможно рабочий, индекс перестройкой не была бы
+            exist_ok=False
+        )
+        self.targets[alias] = index
+        logging.info('rebuild %s into %s', alias, index)
+        return index
+
+    def finish_rebuild(self, alias: str):
+        """Рабочие настройки для перестроенной версии, слияние сегментов и переключение алиаса на нее"""
+        index = self.targets.pop(alias)
+        settings = self.mappings()[alias]["settings"]
+        self.es_client.indices.put_settings(
+            index=index,
+            body={
+                "index": {
+                    "refresh_interval": settings["refresh_interval"],
+                    "number_of_replicas": settings["number_of_replicas"]
+                }
+            }
+        )
+        self.es_client.indices.refresh(index=index)
+        self.es_client.indices.forcemerge(index=index, max_num_segments=1, request_timeout=3600)
+        # алиас переключается, когда все копии шардов новой версии готовы
+        self.es_client.cluster.health(
+            index=index, wait_for_no_initializing_shards=True, timeout='10m', request_timeout=600
+        )
+        self.swap_alias(alias=alias, index=index)
+
+    def abort_rebuild(self, alias: str):
+        """Удаление недостроенной версии; алиас остается на прежней"""
+        index = self.targets.pop(alias, None)
+        if index is not None:
+            self.es_client.indices.delete(index=index, ignore_unavailable=True)
+
+    def swap_alias(self, alias: str, index: str):
+        """
+        Атомарное переключение алиаса на index с удалением прежних версий.
+        Индекс, созданный до перехода на алиасы под тем же именем, удаляется в том же запросе.
+        """
+        if self.es_client.indices.exists_alias(name=alias):
+            previous = [name for name in self.es_client.indices.get_alias(name=alias) if name != index]
+        elif self.es_client.indices.exists(index=alias):
+            previous = [alias]
+        else:
+            previous = []
+        actions = [{"remove_index": {"index": name}} for name in previous]
+        actions.append({"add": {"index": index, "alias": alias}})
+        self.es_client.indices.update_aliases(body={"actions": actions})
+        logging.info('%s -> %s, removed %s', alias, index, previous)
+
+    @staticmethod
+    def actions(index: str, query_set: Iterator[dict], op_type: str = 'update') -> Generator[dict, None, None]:
+        """
+        update дописывает поля в документ (частичные документы от разных стратегий),
+        index записывает документ целиком одной операцией
+        """
         for row in query_set:
-            id_ = row.get('id')
-            actions.append({
-                "_op_type": 'update',
-                "_index": index,
-                "_id": id_,
-                "doc": row,
-                "doc_as_upsert": True
-            })
-        helpers.bulk(self.es_client, actions=actions, index=index)
-        return actions
+            if op_type == 'index':
+                yield {
+                    "_op_type": 'index',
+                    "_index": index,
+                    "_id": row.get('id'),
+                    "_source": row
+                }
+            else:
+                yield {
+                    "_op_type": 'update',
+                    "_index": index,
+                    "_id": row.get('id'),
+                    "doc": row,
+                    "doc_as_upsert": True
+                }
+
+    def upsert(self, index, query_set: Iterator[dict], op_type: str = 'update') -> BulkStats:
+        """
+        Потоковая загрузка: документы забираются из генератора по мере отправки bulk-запросов
+        и не копятся в памяти целиком.
+        """
+        started = time.monotonic()
+        size = self.chunk_size_for(index)
+        backfill = index in self.backfill
+        index = self.targets.get(index, index)
+        actions = self.actions(index=index, query_set=query_set, op_type=op_type)
+        stats = self.send(self.chunks(actions, size=size), self.send_actions)
+        stats.took_ms = int((time.monotonic() - started) * 1000)
+        stats.backfill = backfill
+        return stats
+
+    def upsert_raw(self, index, documents: Iterable[Tuple[str, str]], op_type: str = 'update') -> BulkStats:
+        """
+        Загрузка документов, уже собранных в JSON на стороне БД: пары (id, текст документа)
+        подставляются в тело bulk-запроса как есть, без разбора и повторной сериализации.
+        """
+        started = time.monotonic()
+        size = self.chunk_size_for(index)
+        backfill = index in self.backfill
+        index = self.targets.get(index, index)
+        stats = self.send(
+            self.raw_chunks(index=index, documents=documents, size=size, op_type=op_type),
+            self.send_raw
+        )
+        stats.took_ms = int((time.monotonic() - started) * 1000)
+        stats.backfill = backfill
+        return stats
+
+    def delete(self, index: str, ids: Iterable[str]) -> BulkStats:
+        """Удаление документов, строки которых удалены из БД; документа уже нет в индексе - не ошибка"""
+        started = time.monotonic()
+        index = self.targets.get(index, index)
+        actions = ({"_op_type": 'delete', "_index": index, "_id": id_} for id_ in ids)
+        stats = BulkStats()
+        with self.bulk_slots:
+            for ok, item in helpers.streaming_bulk(
+                    self.es_client,
+                    actions=actions,
+                    chunk_size=self.chunk_size,
+                    max_retries=self.max_retries,
+                    raise_on_error=False
+            ):
+                if ok or item['delete'].get('status') == 404:
+                    stats.deleted += 1
+                else:
+                    stats.failed += 1
+                    logging.error(item)
+        stats.took_ms = int((time.monotonic() - started) * 1000)
+        return stats
+
+    def send(self, chunks: Iterable[list], send_chunk: Callable[[list], BulkStats]) -> BulkStats:
+        if self.bulk_threads > 1:
+            return self.parallel_bulk(chunks, send_chunk)
+
+        stats = BulkStats()
+        for chunk in chunks:
+            stats.merge(send_chunk(chunk))
+        return stats
+
+    def send_actions(self, chunk: List[dict]) -> BulkStats:
+        """
+        Отправка пачки действий. Документы, отклоненные с 429, повторяются
+        с экспоненциальной паузой, поэтому перегруженный кластер замедляет отправителя.
+        """
+        stats = BulkStats()
+        with self.bulk_slots:
+            for ok, item in helpers.streaming_bulk(
+                    self.es_client,
+                    actions=chunk,
+                    chunk_size=len(chunk),
+                    max_chunk_bytes=self.max_chunk_bytes,
+                    max_retries=self.max_retries,
+                    raise_on_error=False
+            ):
+                if ok:
+                    stats.indexed += 1
+                else:
+                    stats.failed += 1
+                    logging.error(item)
+        return stats
+
+    def send_raw(self, chunk: List[Tuple[str, str]]) -> BulkStats:
+        """Отправка пачки готовых строк bulk-запроса; отклоненные с 429 повторяются, как в send_actions"""
+        stats = BulkStats()
+        for attempt in range(self.max_retries + 1):
+            if attempt:
+                time.sleep(min(2 * 2 ** (attempt - 1), 600))
+            with self.bulk_slots:
+                response = self.es_client.bulk(
+                    body=''.join(action + source for action, source in chunk),
+                    filter_path='errors,items.*.status,items.*.error'
+                )
+            if not response.get('errors'):
+                stats.indexed += len(chunk)
+                return stats
+
+            rejected = []
+            for lines, item in zip(chunk, response['items']):
+                result = next(iter(item.values()))
+                if result['status'] == 429:
+                    rejected.append(lines)
+                elif result['status'] >= 300:
+                    stats.failed += 1
+                    logging.error(result)
+                else:
+                    stats.indexed += 1
+            if not rejected:
+                return stats
+            chunk = rejected
+
+        stats.failed += len(chunk)
+        logging.error('%s documents rejected with 429 after %s retries', len(chunk), self.max_retries)
+        return stats
+
+    @staticmethod
+    def chunks(actions: Iterable[dict], size: int) -> Generator[List[dict], None, None]:
+        actions = iter(actions)
+        while chunk := list(islice(actions, size)):
+            yield chunk
+
+    def raw_chunks(
+            self,
+            index: str,
+            documents: Iterable[Tuple[str, str]],
+            size: int,
+            op_type: str = 'update'
+    ) -> Generator[List[Tuple[str, str]], None, None]:
+        """Строки bulk-запроса, нарезанные по числу документов и по размеру тела"""
+        chunk, chunk_bytes = [], 0
+        for id_, document in documents:
+            action = json.dumps({op_type: {'_index': index, '_id': str(id_)}}) + '\n'
+            if op_type == 'index':
+                source = document + '\n'
+            else:
+                source = '{"doc":' + document + ',"doc_as_upsert":true}\n'
+            # размер в символах: для utf-8 это нижняя оценка, запас дает max_chunk_bytes
+            line_size = len(action) + len(source)
+            if chunk and (len(chunk) >= size or chunk_bytes + line_size > self.max_chunk_bytes):
+                yield chunk
+                chunk, chunk_bytes = [], 0
+            chunk.append((action, source))
+            chunk_bytes += line_size
+        if chunk:
+            yield chunk
+
+    def parallel_bulk(self, chunks: Iterable[list], send_chunk: Callable[[list], BulkStats]) -> BulkStats:
+        """
+        Параллельная отправка пачек из пула потоков.
+
+        Число пачек в работе ограничено bulk_queue_size: пока очередь полна, генератор документов
+        (а значит и чтение из БД) не продвигается. Поток, получивший 429, ждет повтора и держит
+        свое место в очереди - так перегрузка кластера доходит до источника.
+        """
+        stats = BulkStats()
+        lock = threading.Lock()
+        in_flight = threading.BoundedSemaphore(self.bulk_queue_size)
+        errors: List[Exception] = []
+
+        def send(chunk: list):
+            try:
+                result = send_chunk(chunk)
+                with lock:
+                    stats.merge(result)
+            except Exception as e:
+                with lock:
+                    errors.append(e)
+            finally:
+                in_flight.release()
+
+        with ThreadPoolExecutor(max_workers=self.bulk_threads, thread_name_prefix='es-bulk') as executor:
+            for chunk in chunks:
+                if errors:
+                    break
+                in_flight.acquire()
+                executor.submit(send, chunk)
+
+        if errors:
+            # ошибки транспорта отдаем наверх, чтобы сработал backoff загрузки
+            raise errors[0]
+        return stats  # noqa: R504 - заполняется из потоков
+
+
+# общий клиент всех стратегий; создается при первом обращении, а не при импорте модулей
+_client: Optional[EsManagement] = None
+_client_lock = threading.Lock()
+
+
+def get_es_client() -> EsManagement:
+    """Общий клиент Elasticsearch: индексы проверяются и создаются при первом обращении"""
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = EsManagement()
+    return _client  # noqa: R504 - глобальный клиент, создается один раз
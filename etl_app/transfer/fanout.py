@@ -0,0 +1,90 @@
+import datetime
+import logging
+
+from psycopg2 import OperationalError, extensions
+from pydantic import BaseModel
+
+from .postgres import get_pool
+from .utils import backoff
+
+
+class FanOutStats(BaseModel):
+    """Цена изменения связанной сущности: сколько фильмов пришлось обновить и за какое время"""
+    entities: int = 0
+    films: int = 0
+    took_ms: int = 0
+
+    @property
+    def films_per_entity(self) -> float:
+        return self.films / self.entities if self.entities else 0
+
+    @property
+    def ms_per_entity(self) -> float:
+        return self.took_ms / self.entities if self.entities else 0
+
+
+class FanOut:
+    """
+    Обратные зависимости фильма: id измененных жанров или персон переводятся в id затронутых фильмов
+    через таблицу связей. Фильмы выбираются страницами по id, и для каждой страницы пересобираются
+    только поля, зависящие от этой сущности.
+    """
+
+    schema = 'content'
+
+    def __init__(self, source_table: str, link_table: str, link_column: str):
+        self.source_table = source_table
+        self.link_table = link_table
+        self.link_column = link_column
+
+    def window_query(self) -> str:
+        """Страница id фильмов, связанных с сущностями, измененными во временном окне"""
+        return f"""
+                SELECT DISTINCT link.film_work_id id
+                FROM {self.schema}.{self.link_table} link
+                JOIN {self.schema}.{self.source_table} source ON source.id = link.{self.link_column}
+                WHERE source.modified BETWEEN %(date_start)s AND %(date_end)s
+                    AND link.film_work_id > %(id)s::uuid
+                ORDER BY id
+                LIMIT %(limit)s
+                """
+
+    def ids_query(self) -> str:
+        """id фильмов, связанных с сущностями из %(ids)s"""
+        return (
+            f'SELECT DISTINCT film_work_id FROM {self.schema}.{self.link_table} '
+            f'WHERE {self.link_column} = ANY(%(ids)s::uuid[])'
+        )
+
+    @backoff(timeout_restriction=180, time_factor=2, exception=OperationalError)
+    def count_changed(self, reference_date_start: datetime.datetime, reference_date_end: datetime.datetime) -> int:
+        with get_pool().connection() as conn, conn.cursor(cursor_factory=extensions.cursor) as cursor:
+            cursor.execute(
+                f'SELECT count(*) FROM {self.schema}.{self.source_table} '
+                f'WHERE modified BETWEEN %(date_start)s AND %(date_end)s',
+                {'date_start': reference_date_start, 'date_end': reference_date_end}
+            )
+            return cursor.fetchone()[0]
+
+    def report(
+            self,
+            reference_date_start: datetime.datetime,
+            reference_date_end: datetime.datetime,
+            films: int,
+            took_ms: int
+    ) -> FanOutStats:
+        stats = FanOutStats(
+            entities=self.count_changed(reference_date_start, reference_date_end),
+            films=films,
+            took_ms=took_ms
+        )
+        self.log(stats)
+        return stats
+
+    def log(self, stats: FanOutStats):
+        if stats.entities:
+            logging.info(
+                'fan-out %s -> film_work: %s changed, %s films, %.1f films and %.1f ms per %s',
+                self.source_table, stats.entities, stats.films,
+                stats.films_per_entity, stats.ms_per_entity, self.source_table
+            )
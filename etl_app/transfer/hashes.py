@@ -0,0 +1,109 @@
+import dbm
+import hashlib
+import json
+import threading
+from abc import ABC, abstractmethod
+from itertools import islice
+from typing import Dict, Generator, Iterable, List, Optional, Sequence, Union
+
+from redis import Redis
+
+
+class BaseHashStore(ABC):
+    """Хэши содержимого последних отправленных в Elasticsearch документов"""
+
+    @abstractmethod
+    def get_many(self, key: str, ids: Sequence[str]) -> List[Optional[str]]:
+        """Хэши документов ids в пространстве key; None - документ еще не отправлялся"""
+        pass
+
+    @abstractmethod
+    def set_many(self, key: str, hashes: Dict[str, str]) -> None:
+        """Сохранить хэши отправленных документов"""
+        pass
+
+
+class FileHashStore(BaseHashStore):
+    def __init__(self, file_path: str = 'hashes.db'):
+        self.db = dbm.open(file_path, 'c')
+        self._lock = threading.Lock()
+
+    def get_many(self, key: str, ids: Sequence[str]) -> List[Optional[str]]:
+        with self._lock:
+            values = [self.db.get(f'{key}:{id_}') for id_ in ids]
+        return [value.decode() if value is not None else None for value in values]
+
+    def set_many(self, key: str, hashes: Dict[str, str]) -> None:
+        with self._lock:
+            for id_, value in hashes.items():
+                self.db[f'{key}:{id_}'] = value
+            # не все реализации dbm умеют сбрасывать данные на диск
+            if hasattr(self.db, 'sync'):
+                self.db.sync()
+
+
+class RedisHashStore(BaseHashStore):
+    def __init__(self, redis_adapter: Redis, prefix: str = 'etl_hashes'):
+        self.redis_adapter = redis_adapter
+        self.prefix = prefix
+
+    def get_many(self, key: str, ids: Sequence[str]) -> List[Optional[str]]:
+        values = self.redis_adapter.hmget(f'{self.prefix}:{key}', list(ids))
+        return [value.decode() if isinstance(value, bytes) else value for value in values]
+
+    def set_many(self, key: str, hashes: Dict[str, str]) -> None:
+        if hashes:
+            self.redis_adapter.hset(f'{self.prefix}:{key}', mapping=hashes)
+
+
+def content_hash(document: Union[dict, str]) -> str:
+    """Короткий хэш содержимого: документ, собранный в БД, хэшируется как есть, словарь - в каноническом JSON"""
+    if not isinstance(document, str):
+        document = json.dumps(document, sort_keys=True, separators=(',', ':'), default=str)
+    return hashlib.blake2b(document.encode(), digest_size=8).hexdigest()
+
+
+class ChangedDocuments:
+    """
+    Фильтр документов перед bulk-запросом: документ, содержимое которого не изменилось
+    с прошлой отправки, не отправляется. Новые хэши сохраняются только после успешной загрузки.
+    Без skip отправляются все документы, а хэши только обновляются.
+    """
+
+    def __init__(self, store: BaseHashStore, key: str, batch_size: int = 1000, skip: bool = True):
+        self.store = store
+        self.key = key
+        self.skip = skip
+        self.batch_size = batch_size
+        self.skipped = 0
+        self.pending: Dict[str, str] = {}
+
+    @staticmethod
+    def document_id(document: Union[dict, tuple]) -> str:
+        # документы, собранные в БД, приходят парами (id, текст документа)
+        return str(document[0] if isinstance(document, tuple) else document['id'])
+
+    def filter(self, documents: Iterable[Union[dict, tuple]]) -> Generator[Union[dict, tuple], None, None]:
+        documents = iter(documents)
+        while batch := list(islice(documents, self.batch_size)):
+            ids = [self.document_id(document) for document in batch]
+            previous = self.store.get_many(self.key, ids)
+            for id_, document, old in zip(ids, batch, previous):
+                new = content_hash(document[1] if isinstance(document, tuple) else document)
+                if new == old and self.skip:
+                    self.skipped += 1
+                    continue
+                self.pending[id_] = new
+                yield document
+
+    def commit(self):
+        self.store.set_many(self.key, self.pending)
+        self.pending = {}
+
+
+# общее хранилище хэшей; None - документы отправляются без проверки
+store: Optional[BaseHashStore] = None
+
+
+def get_store() -> Optional[BaseHashStore]:
+    return store
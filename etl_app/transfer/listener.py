@@ -0,0 +1,97 @@
+import json
+import select
+from collections import defaultdict
+from typing import Dict, Optional, Set
+
+from psycopg2 import OperationalError, connect, extensions
+
+from .postgres import get_pool
+from .utils import backoff
+
+CHANNEL = 'etl_changes'
+
+# таблица и колонка, id из которой уходит в уведомление
+NOTIFY_TABLES = {
+    'film_work': 'id',
+    'genre': 'id',
+    'person': 'id',
+    'genre_film_work': 'film_work_id',
+    'person_film_work': 'film_work_id',
+}
+
+TRIGGER_FUNCTION = f"""
+    CREATE OR REPLACE FUNCTION content.etl_notify_change() RETURNS trigger AS $$
+    DECLARE
+        changed record;
+    BEGIN
+        IF TG_OP = 'DELETE' THEN
+            changed := OLD;
+        ELSE
+            changed := NEW;
+        END IF;
+        PERFORM pg_notify(
+            '{CHANNEL}',
+            json_build_object('table', TG_TABLE_NAME, 'id', to_jsonb(changed) ->> TG_ARGV[0])::text
+        );
+        RETURN NULL;
+    END;
+    $$ LANGUAGE plpgsql;
+    """
+
+TRIGGER = """
+    DROP TRIGGER IF EXISTS etl_notify_change ON content.{table};
+    CREATE TRIGGER etl_notify_change
+        AFTER INSERT OR UPDATE OR DELETE ON content.{table}
+        FOR EACH ROW EXECUTE PROCEDURE content.etl_notify_change('{column}');
+    """
+
+
+class ChangeListener:
+    """
+    Подписка на уведомления триггеров об изменениях в схеме content.
+
+    Использует собственное соединение в режиме autocommit вне общего пула: LISTEN действует,
+    пока соединение открыто. Уведомления, пришедшие во время переподключения, теряются -
+    их подхватывает обычный проход по временному окну.
+    """
+
+    def __init__(self, **dsn):
+        self.dsn = dsn
+        self.conn: Optional[extensions.connection] = None
+
+    @staticmethod
+    @backoff(timeout_restriction=180, time_factor=2, exception=OperationalError)
+    def install():
+        """Создание триггеров, сообщающих об изменениях строк"""
+        with get_pool().connection() as conn, conn.cursor() as cursor:
+            cursor.execute(TRIGGER_FUNCTION)
+            for table, column in NOTIFY_TABLES.items():
+                cursor.execute(TRIGGER.format(table=table, column=column))
+
+    def connect(self) -> extensions.connection:
+        if self.conn is None or self.conn.closed:
+            self.conn = connect(**self.dsn)
+            self.conn.set_isolation_level(extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+            with self.conn.cursor() as cursor:
+                cursor.execute(f'LISTEN {CHANNEL};')
+        return self.conn
+
+    @backoff(timeout_restriction=180, time_factor=2, exception=OperationalError)
+    def wait(self, timeout: float) -> Dict[str, Set[str]]:
+        """Ожидание уведомлений не дольше timeout секунд; результат - id измененных строк по таблицам"""
+        conn = self.connect()
+        changes = defaultdict(set)
+        try:
+            if select.select([conn], [], [], timeout) != ([], [], []):
+                conn.poll()
+                while conn.notifies:
+                    payload = json.loads(conn.notifies.pop(0).payload)
+                    changes[payload['table']].add(payload['id'])
+        except OperationalError:
+            conn.close()
+            raise
+        return changes
+
+    def close(self):
+        if self.conn is not None and not self.conn.closed:
+            self.conn.close()
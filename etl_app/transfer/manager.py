@@ -1,23 +1,136 @@
 import datetime
-from typing import Tuple, Union
+import json
+import logging
+import time
+from functools import partial
+from typing import Dict, Optional, Sequence, Set, Tuple, Type, Union
 
-from .strategy import (FilmWorkTableStrategyFabric, GenreTableStrategyFabric,
+from .elastic import BulkError
+from .fanout import FanOutStats
+from .pipeline import Pipeline
+from .settings import EtlMode, Settings
+from .state import State
+from .strategy import (ContentTableStrategyFabric,
+                       FilmWorkTableStrategyFabric, GenreTableStrategyFabric,
                        GenreTableStrategyGenreIndexFabric,
-                       PersonTableStrategyFabric,
+                       MovieTableStrategyFabric, PersonTableStrategyFabric,
                        PersonTableStrategyPersonIndexFabric)
+from .transform_pool import get_transform_pool
+from .utils import backoff
+from .validators import Position, Watermark
+from .watermarks import earliest_update
 
 
 class Manager:
-    def __init__(self):
-        self.chain = (
-            FilmWorkTableStrategyFabric,
-            GenreTableStrategyFabric,
-            PersonTableStrategyFabric,
-            GenreTableStrategyGenreIndexFabric,
-            PersonTableStrategyPersonIndexFabric
-        )
+    default_chain = (
+        FilmWorkTableStrategyFabric,
+        GenreTableStrategyFabric,
+        PersonTableStrategyFabric,
+        GenreTableStrategyGenreIndexFabric,
+        PersonTableStrategyPersonIndexFabric
+    )
+    # документы фильмов собираются целиком одной стратегией
+    merged_chain = (
+        MovieTableStrategyFabric,
+        GenreTableStrategyGenreIndexFabric,
+        PersonTableStrategyPersonIndexFabric
+    )
+
+    def __init__(
+            self,
+            mode: EtlMode = EtlMode.batch,
+            itersize: int = 2000,
+            pipeline_queue_size: int = 2,
+            chain: Optional[Sequence[Type[ContentTableStrategyFabric]]] = None,
+            state: Optional[State] = None,
+            raw_json: bool = False,
+            strict_validation: bool = False
+    ):
+        self.mode = mode
+        # параметры, с которыми создаются стратегии цепочки
+        self.strategy_options = dict(raw_json=raw_json, strict_validation=strict_validation)
+        self.itersize = itersize
+        self.pipeline_queue_size = pipeline_queue_size
+        self.chain = tuple(chain or self.default_chain)
         self.strategy_index = 0
-        self._strategy = self.chain[self.strategy_index]()
+        self._strategy = self.chain[self.strategy_index](**self.strategy_options)
+        # ключ последней загруженной строки текущей таблицы
+        self.position: Optional[Position] = None
+        # постоянное хранилище прогресса стратегий и позиции, с которых они продолжат после перезапуска
+        self.state = state
+        self.resume: Dict[str, Position] = {}
+        # сколько строк обработано с начала текущего окна
+        self.processed = 0
+        # сколько строк текущей таблицы обработано в окне и когда начата таблица
+        self.table_rows = 0
+        self.table_started = time.monotonic()
+        # трансформация пачек в общем пуле процессов; None - в текущем процессе
+        self.transform_pool = get_transform_pool()
+
+    @classmethod
+    def from_settings(
+            cls,
+            settings: Settings,
+            chain: Optional[Sequence[Type[ContentTableStrategyFabric]]] = None,
+            state: Optional[State] = None
+    ) -> 'Manager':
+        return cls(
+            mode=settings.mode,
+            itersize=settings.itersize,
+            pipeline_queue_size=settings.pipeline_queue_size,
+            chain=chain or cls.chain_for(settings),
+            state=state,
+            raw_json=settings.raw_json,
+            strict_validation=settings.strict_validation
+        )
+
+    @classmethod
+    def chain_for(cls, settings: Settings) -> Tuple[Type[ContentTableStrategyFabric], ...]:
+        return cls.merged_chain if settings.merge_movies else cls.default_chain
+
+    @property
+    def pooled(self) -> bool:
+        """Трансформация текущей таблицы идет в пуле процессов; готовые документы из БД в нем не нуждаются"""
+        return self.transform_pool is not None and not self.table.raw_json
+
+    @property
+    def state_key(self) -> str:
+        return self.table.__class__.__name__
+
+    def commit(self, date_start: datetime.datetime, position: Optional[Position]):
+        """Сохранение прогресса текущей стратегии после успешной загрузки"""
+        if self.state is not None:
+            watermark = Watermark(date_start=date_start, position=position)
+            self.state.set_state(self.state_key, json.loads(watermark.json()))
+
+    def restore(self, default_date_start: Optional[datetime.datetime] = None) -> datetime.datetime:
+        """
+        Начало окна по сохраненному прогрессу стратегий цепочки.
+
+        Окно начинается с самого раннего сохраненного начала; стратегии, остановившиеся в этом окне,
+        продолжают со своего ключа. Для стратегий без прогресса начало берется из default_date_start,
+        а если он не задан - по самому раннему изменению в их таблицах.
+        """
+        watermarks = {}
+        for strategy in self.chain:
+            raw = self.state.get_state(strategy.__name__) if self.state is not None else None
+            if raw is not None:
+                watermarks[strategy.__name__] = Watermark.parse_obj(raw)
+
+        starts = [watermark.date_start for watermark in watermarks.values()]
+        missing = [strategy for strategy in self.chain if strategy.__name__ not in watermarks]
+        if missing:
+            starts.append(default_date_start or earliest_update(
+                tables=sorted({table for strategy in missing for table in strategy.modified_tables})
+            ))
+        date_start = min(starts)
+
+        self.resume = {
+            name: watermark.position for name, watermark in watermarks.items()
+            if watermark.date_start == date_start and watermark.position is not None
+        }
+        self.position = self.resume.pop(self.state_key, None)
+        return date_start
 
     @property
     def table(self) -> Union[
@@ -51,31 +164,188 @@ class Manager:
         else:
             is_done_time = False
 
-        self.table = self.chain[self.strategy_index]()
+        self.table = self.chain[self.strategy_index](**self.strategy_options)
+        self.position = self.resume.pop(self.state_key, None)
+        self.table_rows = 0
+        self.table_started = time.monotonic()
         return is_done_time
 
+    def finish_table(self, reference_date_start: datetime.datetime, reference_date_end: datetime.datetime) -> bool:
+        """Окно текущей таблицы пройдено: следующее для нее начнется с конца этого окна"""
+        self.commit(date_start=reference_date_end, position=None)
+        if self.table.fanout is not None and self.table_rows:
+            self.table.fanout.report(
+                reference_date_start=reference_date_start,
+                reference_date_end=reference_date_end,
+                films=self.table_rows,
+                took_ms=int((time.monotonic() - self.table_started) * 1000)
+            )
+        if self.transform_pool is not None:
+            self.transform_pool.report(self.table.table_name)
+        return self.switch_table()
+
     def start(
             self,
             reference_date_start: datetime.datetime,
             reference_date_end: datetime.datetime,
-            query_limit: int,
-            offset: int
+            query_limit: int
     ) -> Tuple[bool, bool]:
-        """Процесс получения данных из БД, обработки и загрузки в Elasticsearch"""
-        qs = self.table.extract(
+        """
+        Процесс получения данных из БД, обработки и загрузки в Elasticsearch.
+
+        Каждая страница начинается после ключа последней загруженной строки,
+        поэтому время запроса не растет с глубиной выборки.
+        """
+        if self.mode == EtlMode.stream:
+            return self.stream(
+                reference_date_start=reference_date_start,
+                reference_date_end=reference_date_end
+            )
+        if self.mode == EtlMode.pipeline:
+            return self.pipeline(
+                reference_date_start=reference_date_start,
+                reference_date_end=reference_date_end,
+                query_limit=query_limit
+            )
+
+        rows = self.page(
             reference_date_start=reference_date_start,
             reference_date_end=reference_date_end,
-            query_limit=query_limit,
-            offset=offset
+            query_limit=query_limit
         )
 
-        if not qs:
-            is_done_time = self.switch_table()
+        # неполная страница - последняя в окне, лишний пустой запрос не нужен
+        if rows < query_limit:
+            is_done_time = self.finish_table(reference_date_start, reference_date_end)
             is_done_table = True
         else:
-            result = self.table.transform(qs)
-            self.table.load(qs=result)
             is_done_time = False
             is_done_table = False
 
         return is_done_table, is_done_time
+
+    @backoff(timeout_restriction=180, time_factor=2, exception=BulkError)
+    def page(
+            self,
+            reference_date_start: datetime.datetime,
+            reference_date_end: datetime.datetime,
+            query_limit: int
+    ) -> int:
+        """
+        Очередная страница окна после сохраненного ключа. Ключ сохраняется, только если все документы
+        страницы записаны; иначе страница целиком читается и загружается заново с прежнего ключа.
+        """
+        page = dict(
+            reference_date_start=reference_date_start,
+            reference_date_end=reference_date_end,
+            query_limit=query_limit,
+            position=self.position
+        )
+        if self.pooled:
+            # строки кортежами уходят в процессы-воркеры порциями
+            columns, qs = self.table.extract_rows(**page)
+        else:
+            qs = self.table.extract(**page)
+
+        if qs:
+            if self.pooled:
+                result = self.transform_pool.transform(self.table, columns, qs)
+                last = dict(zip(columns, qs[-1]))
+            else:
+                result = self.table.transform(qs)
+                last = qs[-1]
+            stats = self.table.load(qs=result)
+            logging.info('%s -> %s: %s', self.table.table_name, self.table.es_index, stats)
+            if stats.failed:
+                raise BulkError(stats)
+            self.position = self.table.position(last)
+            self.commit(date_start=reference_date_start, position=self.position)
+
+        self.processed += len(qs)
+        self.table_rows += len(qs)
+        return len(qs)
+
+    @backoff(timeout_restriction=180, time_factor=2, exception=BulkError)
+    def stream(
+            self,
+            reference_date_start: datetime.datetime,
+            reference_date_end: datetime.datetime
+    ) -> Tuple[bool, bool]:
+        """Окно текущей таблицы целиком: строки из серверного курсора сразу идут в трансформацию и загрузку"""
+        stats = self.table.stream_load(
+            reference_date_start=reference_date_start,
+            reference_date_end=reference_date_end,
+            itersize=self.itersize
+        )
+        logging.info('%s -> %s: %s', self.table.table_name, self.table.es_index, stats)
+        if stats.failed:
+            # окно не закрывается и загружается заново целиком
+            raise BulkError(stats)
+        self.processed += stats.indexed
+        self.table_rows += stats.indexed
+        return True, self.finish_table(reference_date_start, reference_date_end)
+
+    @backoff(timeout_restriction=180, time_factor=2, exception=BulkError)
+    def pipeline(
+            self,
+            reference_date_start: datetime.datetime,
+            reference_date_end: datetime.datetime,
+            query_limit: int
+    ) -> Tuple[bool, bool]:
+        """
+        Окно текущей таблицы конвейером: следующая страница читается, пока предыдущая загружается.
+        Если часть документов не записана, окно повторяется с ключа последней полностью загруженной пачки.
+        """
+        pipeline = Pipeline(
+            strategy=self.table,
+            queue_size=self.pipeline_queue_size,
+            transform=partial(self.transform_pool.transform_dicts, self.table) if self.pooled else None,
+            on_load=lambda position: self.commit(date_start=reference_date_start, position=position)
+        )
+        try:
+            pipeline.run(
+                reference_date_start=reference_date_start,
+                reference_date_end=reference_date_end,
+                query_limit=query_limit,
+                position=self.position
+            )
+        finally:
+            self.position = pipeline.position
+            self.processed += pipeline.stats['extract'].rows
+            self.table_rows += pipeline.stats['extract'].rows
+        return True, self.finish_table(reference_date_start, reference_date_end)
+
+    def reindex(self, changes: Dict[str, Set[str]], query_limit: int) -> int:
+        """Переиндексация только документов, затронутых изменениями из уведомлений БД"""
+        processed = 0
+        # индекс -> документы, уже удаленные другой стратегией того же индекса
+        deleted: Dict[str, Set[str]] = {}
+        for strategy in self.chain:
+            table = strategy(**self.strategy_options)
+            started = time.monotonic()
+            index_deleted = deleted.setdefault(table.es_index, set())
+            # удаленный документ не записывается снова: частичное обновление воссоздало бы его заглушкой
+            ids = sorted(table.affected_ids(changes) - index_deleted)
+            for i in range(0, len(ids), query_limit):
+                batch = ids[i:i + query_limit]
+                qs = table.extract_ids(batch)
+                if qs:
+                    stats = table.load(qs=table.transform(qs))
+                    processed += len(qs)
+                    logging.info('%s -> %s by ids: %s', table.table_name, table.es_index, stats)
+                # триггеры сообщают и об удалении строк: документы удаленных строк убираются из индекса
+                found = {str(row['id']) for row in qs}
+                candidates = [id_ for id_ in batch if id_ not in found]
+                gone = table.missing_ids(candidates) if candidates else []
+                if gone:
+                    stats = table.delete(gone)
+                    index_deleted.update(gone)
+                    processed += len(gone)
+                    logging.info('%s -> %s deleted by ids: %s', table.table_name, table.es_index, stats)
+            if table.fanout is not None:
+                table.fanout.log(FanOutStats(
+                    entities=len(changes.get(table.fanout.source_table, ())),
+                    films=len(ids),
+                    took_ms=int((time.monotonic() - started) * 1000)
+                ))
+        return processed
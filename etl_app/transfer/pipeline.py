@@ -0,0 +1,169 @@
+import datetime
+import logging
+import queue
+import threading
+import time
+from typing import Any, Callable, List, Optional
+
+from pydantic import BaseModel
+
+from .elastic import BulkError
+from .strategy import ContentTableStrategyFabric
+from .validators import Position
+
+# маркер конца данных в очереди
+_DONE = object()
+
+
+class StageStats(BaseModel):
+    """Производительность этапа конвейера"""
+    name: str
+    rows: int = 0
+    # время работы этапа без ожидания очередей
+    busy_s: float = 0
+    # наибольшая глубина входной очереди этапа
+    max_queue_depth: int = 0
+
+    @property
+    def rows_per_sec(self) -> float:
+        return self.rows / self.busy_s if self.busy_s else 0
+
+    def __str__(self):
+        return (
+            f'{self.name}: {self.rows} rows, {self.rows_per_sec:.0f} rows/s, '
+            f'busy {self.busy_s:.2f}s, max queue {self.max_queue_depth}'
+        )
+
+
+class Pipeline:
+    """
+    Конвейер для окна одной таблицы: извлечение, трансформация и загрузка идут в отдельных потоках,
+    связанных ограниченными очередями. Пока пачка N загружается в Elasticsearch, пачка N+1 уже
+    читается из Postgres. Самый медленный этап видно по времени работы и глубине очереди перед ним.
+    """
+
+    def __init__(
+            self,
+            strategy: ContentTableStrategyFabric,
+            queue_size: int = 2,
+            transform: Optional[Callable[[List[dict]], List[dict]]] = None,
+            on_load: Optional[Callable[[Position], None]] = None
+    ):
+        self.strategy = strategy
+        # трансформация пачки, если она идет не в потоке конвейера, а, например, в пуле процессов
+        self.transform_batch = transform or (lambda qs: list(strategy.transform(qs)))
+        # вызывается с ключом последней строки каждой загруженной пачки
+        self.on_load = on_load
+        self.transform_queue = queue.Queue(maxsize=queue_size)
+        self.load_queue = queue.Queue(maxsize=queue_size)
+        self.stop = threading.Event()
+        self.errors: List[BaseException] = []
+        self.stats = {name: StageStats(name=name) for name in ('extract', 'transform', 'load')}
+        # ключ последней загруженной строки
+        self.position: Optional[Position] = None
+
+    def put(self, q: queue.Queue, item: Any):
+        while not self.stop.is_set():
+            try:
+                q.put(item, timeout=0.5)
+                return
+            except queue.Full:
+                continue
+
+    def get(self, q: queue.Queue, stats: StageStats) -> Any:
+        stats.max_queue_depth = max(stats.max_queue_depth, q.qsize())
+        while not self.stop.is_set():
+            try:
+                return q.get(timeout=0.5)
+            except queue.Empty:
+                continue
+        return _DONE
+
+    def extract(
+            self,
+            reference_date_start: datetime.datetime,
+            reference_date_end: datetime.datetime,
+            query_limit: int,
+            position: Optional[Position]
+    ):
+        stats = self.stats['extract']
+        while not self.stop.is_set():
+            started = time.monotonic()
+            qs = self.strategy.extract(
+                reference_date_start=reference_date_start,
+                reference_date_end=reference_date_end,
+                query_limit=query_limit,
+                position=position
+            )
+            stats.busy_s += time.monotonic() - started
+            if qs:
+                stats.rows += len(qs)
+                position = self.strategy.position(qs[-1])
+                self.put(self.transform_queue, (qs, position))
+            if len(qs) < query_limit:
+                break
+        self.put(self.transform_queue, _DONE)
+
+    def transform(self):
+        stats = self.stats['transform']
+        while (item := self.get(self.transform_queue, stats)) is not _DONE:
+            qs, position = item
+            started = time.monotonic()
+            docs = self.transform_batch(qs)
+            stats.busy_s += time.monotonic() - started
+            stats.rows += len(docs)
+            self.put(self.load_queue, (docs, position))
+        self.put(self.load_queue, _DONE)
+
+    def load(self):
+        stats = self.stats['load']
+        while (item := self.get(self.load_queue, stats)) is not _DONE:
+            docs, position = item
+            started = time.monotonic()
+            result = self.strategy.load(qs=docs)
+            stats.busy_s += time.monotonic() - started
+            stats.rows += result.indexed
+            if result.failed:
+                # ключ пачки с незаписанными документами не сохраняется: окно продолжится с прошлой пачки
+                raise BulkError(result)
+            self.position = position
+            if self.on_load is not None:
+                self.on_load(position)
+
+    def stage(self, target: Callable, *args) -> threading.Thread:
+        def run():
+            try:
+                target(*args)
+            except BaseException as e:
+                self.errors.append(e)
+                self.stop.set()
+
+        return threading.Thread(target=run, name=f'etl-{target.__name__}', daemon=True)
+
+    def run(
+            self,
+            reference_date_start: datetime.datetime,
+            reference_date_end: datetime.datetime,
+            query_limit: int,
+            position: Optional[Position] = None
+    ) -> List[StageStats]:
+        self.position = position
+        threads = [
+            self.stage(self.extract, reference_date_start, reference_date_end, query_limit, position),
+            self.stage(self.transform),
+            self.stage(self.load),
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        if self.errors:
+            raise self.errors[0]
+
+        report = list(self.stats.values())
+        logging.info(
+            '%s -> %s pipeline: %s',
+            self.strategy.table_name, self.strategy.es_index, '; '.join(str(stage) for stage in report)
+        )
+        return report
@@ -0,0 +1,102 @@
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Optional
+
+from psycopg2 import InterfaceError, OperationalError, extensions, extras
+from psycopg2.pool import ThreadedConnectionPool
+
+
+class PostgresPool:
+    """
+    Долгоживущий пул соединений с Postgres, общий для всех стратегий.
+
+    Соединение, простоявшее дольше check_interval, проверяется перед выдачей.
+    Разорванное во время работы соединение выбрасывается из пула, а ошибка пробрасывается
+    дальше, чтобы backoff повторил запрос уже на новом соединении.
+    """
+
+    def __init__(self, minconn: int = 1, maxconn: int = 5, check_interval: int = 30, **dsn):
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.check_interval = check_interval
+        self.dsn = dsn
+        self._pool: Optional[ThreadedConnectionPool] = None
+        self._lock = threading.Lock()
+        # ThreadedConnectionPool не ждет освобождения соединения, а падает - ждем сами
+        self._slots = threading.BoundedSemaphore(maxconn)
+        self._last_used: Dict[int, float] = {}
+
+    @property
+    def pool(self) -> ThreadedConnectionPool:
+        # пул открывается при первом обращении, недоступность БД обрабатывает backoff вызывающего
+        with self._lock:
+            if self._pool is None or self._pool.closed:
+                self._pool = ThreadedConnectionPool(self.minconn, self.maxconn, **self.dsn)
+            return self._pool
+
+    def is_alive(self, conn: extensions.connection) -> bool:
+        """Проверка соединения перед выдачей из пула"""
+        if conn.closed:
+            return False
+        if time.monotonic() - self._last_used.get(id(conn), 0) < self.check_interval:
+            return True
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute('SELECT 1')
+            conn.rollback()
+        except (OperationalError, InterfaceError):
+            return False
+        return True
+
+    def discard(self, pool: ThreadedConnectionPool, conn: extensions.connection):
+        self._last_used.pop(id(conn), None)
+        pool.putconn(conn, close=True)
+
+    @contextmanager
+    def connection(self) -> extensions.connection:
+        with self._slots:
+            pool = self.pool
+            conn = pool.getconn()
+            while not self.is_alive(conn):
+                self.discard(pool, conn)
+                conn = pool.getconn()
+
+            try:
+                yield conn
+                conn.commit()
+            except (OperationalError, InterfaceError):
+                self.discard(pool, conn)
+                raise
+            except BaseException:
+                if not conn.closed:
+                    conn.rollback()
+                pool.putconn(conn)
+                raise
+            self._last_used[id(conn)] = time.monotonic()
+            pool.putconn(conn)
+
+    def close(self):
+        with self._lock:
+            if self._pool is not None and not self._pool.closed:
+                self._pool.closeall()
+            self._last_used.clear()
+
+
+pool: Optional[PostgresPool] = None
+
+
+def get_pool() -> PostgresPool:
+    """Общий пул соединений: настраивается при старте ETL, иначе собирается из переменных окружения"""
+    global pool
+    if pool is None:
+        pool = PostgresPool(
+            dbname=os.environ.get('DB_NAME'),
+            user=os.environ.get('DB_USER'),
+            password=os.environ.get('DB_PASSWORD'),
+            host=os.environ.get('DB_HOST', '127.0.0.1'),
+            port=os.environ.get('DB_PORT', 5432),
+            cursor_factory=extras.RealDictCursor
+        )
+    return pool
@@ -0,0 +1,62 @@
+import datetime
+import logging
+from typing import List, Optional, Sequence, Type
+
+from .elastic import get_es_client
+from .manager import Manager
+from .settings import Settings
+from .strategy import ContentTableStrategyFabric
+
+
+class Rebuild:
+    """
+    Полная перестройка индексов без простоя поиска.
+
+    Цепочка стратегий загружает всю историю в новые версии индексов, пока сервисы читают старые
+    через алиасы; затем догоняет изменения, пришедшие за время загрузки, и переключает алиасы.
+    Прогресс основной синхронизации не меняется: она продолжает писать в алиасы.
+    """
+
+    def __init__(
+            self,
+            settings: Settings,
+            chain: Optional[Sequence[Type[ContentTableStrategyFabric]]] = None
+    ):
+        self.date_start = settings.date_start or settings.get_the_earliest_update()
+        self.query_limit = settings.qs_limit
+        self.manager = Manager.from_settings(settings, chain=chain)
+        self.es = get_es_client()
+
+    @property
+    def aliases(self) -> List[str]:
+        return sorted({strategy.es_index for strategy in self.manager.chain})
+
+    def sync(self, reference_date_start: datetime.datetime, reference_date_end: datetime.datetime):
+        """Одно временное окно для всей цепочки стратегий"""
+        is_done_time = False
+        while not is_done_time:
+            _, is_done_time = self.manager.start(
+                reference_date_start=reference_date_start,
+                reference_date_end=reference_date_end,
+                query_limit=self.query_limit
+            )
+
+    def run(self):
+        try:
+            for alias in self.aliases:
+                self.es.begin_rebuild(alias)
+            date_end = datetime.datetime.now()
+            self.sync(self.date_start, date_end)
+            # изменения за время полной загрузки
+            date_start, date_end = date_end, datetime.datetime.now()
+            self.sync(date_start, date_end)
+            for alias in self.aliases:
+                self.es.finish_rebuild(alias)
+        except BaseException:
+            for alias in self.aliases:
+                self.es.abort_rebuild(alias)
+            raise
+        else:
+            # изменения между последним проходом и переключением алиасов, уже через алиасы
+            self.sync(date_end, datetime.datetime.now())
+            logging.info('rebuild of %s done', ', '.join(self.aliases))
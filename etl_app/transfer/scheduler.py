@@ -0,0 +1,179 @@
+import datetime
+import logging
+import threading
+import time
+from typing import List, Optional, Sequence, Set, Type
+
+from .elastic import get_es_client
+from .listener import ChangeListener
+from .manager import Manager
+from .settings import Settings
+from .state import State
+from .strategy import ContentTableStrategyFabric
+
+
+class PollInterval:
+    """
+    Пауза между проходами по временному окну.
+
+    Если за проход накопилась хотя бы полная страница изменений, следующий проход начинается сразу;
+    если изменения были - через min_interval; пока изменений нет, пауза растет до max_interval.
+    """
+
+    def __init__(self, min_interval: float, max_interval: float, backlog: int, factor: float = 2):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backlog = backlog
+        self.factor = factor
+        self.current = min_interval
+
+    def next(self, processed: int) -> float:
+        if processed >= self.backlog:
+            self.current = self.min_interval
+            return 0
+        if processed:
+            self.current = self.min_interval
+        else:
+            self.current = min(self.current * self.factor, self.max_interval)
+        return self.current
+
+
+def steady_profile(aliases: Set[str]):
+    """Рабочий профиль индексов при запуске синхронизации: профиль догоняющей загрузки мог остаться после аварийной остановки"""
+    es_client = get_es_client()
+    for alias in sorted(aliases):
+        es_client.put_profile(alias, backfill=False)
+
+
+class Worker(threading.Thread):
+    """Цикл синхронизации цепочки стратегий со своим временным окном и позицией"""
+
+    def __init__(
+            self,
+            settings: Settings,
+            chain: Optional[Sequence[Type[ContentTableStrategyFabric]]] = None,
+            stop: Optional[threading.Event] = None,
+            state: Optional[State] = None,
+            restore_profile: bool = True
+    ):
+        self.manager = Manager.from_settings(settings, chain=chain, state=state)
+        super().__init__(name=f'etl-{"-".join(table.__name__ for table in self.manager.chain)}', daemon=True)
+        self.query_limit = settings.qs_limit
+        # продолжаем с сохраненного прогресса, если он есть
+        self.date_start = self.manager.restore(default_date_start=settings.date_start)
+        self.date_end = settings.date_end
+        self.stop = stop or threading.Event()
+        self.error: Optional[BaseException] = None
+        self.poll_interval = PollInterval(
+            min_interval=settings.poll_min_interval,
+            max_interval=settings.poll_max_interval,
+            backlog=settings.qs_limit
+        )
+        # между проходами по окну воркер переиндексирует записи из уведомлений БД
+        self.listener = ChangeListener(**settings.dsn) if settings.listen else None
+        # окно длиннее порога - воркер догоняет, и индексы переводятся на профиль массовой загрузки
+        self.backfill_threshold = settings.backfill_threshold
+        self.backfill = False
+        # воркеры планировщика делят алиасы, поэтому профиль при запуске восстанавливает планировщик
+        self.restore_profile = restore_profile
+
+    @property
+    def aliases(self) -> Set[str]:
+        return {strategy.es_index for strategy in self.manager.chain}
+
+    def profile(self):
+        """Переключение профиля индексов по длине текущего окна"""
+        backfill = bool(self.backfill_threshold) and (
+            (self.date_end - self.date_start).total_seconds() > self.backfill_threshold
+        )
+        if backfill == self.backfill:
+            return
+        es_client = get_es_client()
+        for alias in self.aliases:
+            if backfill:
+                es_client.begin_backfill(alias)
+            else:
+                es_client.end_backfill(alias)
+        self.backfill = backfill
+
+    def idle(self):
+        """Пауза после прохода по окну, зависящая от того, сколько изменений в нем нашлось"""
+        delay = self.poll_interval.next(self.manager.processed)
+        self.manager.processed = 0
+        if not delay:
+            return
+        if self.listener is None:
+            self.stop.wait(delay)
+            return
+
+        # проход по окну остается страховкой на случай потерянных уведомлений и продвигает прогресс,
+        # поэтому выполняется редко, а между проходами обрабатываются только уведомления
+        deadline = time.monotonic() + self.poll_interval.max_interval
+        while not self.stop.is_set() and (remaining := deadline - time.monotonic()) > 0:
+            changes = self.listener.wait(timeout=remaining)
+            if changes:
+                self.manager.reindex(changes, query_limit=self.query_limit)
+
+    def run(self):
+        try:
+            if self.restore_profile:
+                steady_profile(self.aliases)
+            while not self.stop.is_set():
+                self.profile()
+                _, is_done_time = self.manager.start(
+                    reference_date_start=self.date_start,
+                    reference_date_end=self.date_end,
+                    query_limit=self.query_limit
+                )
+
+                if is_done_time:
+                    self.idle()
+                    self.date_start = self.date_end
+                    self.date_end = datetime.datetime.now()
+        except BaseException as e:
+            self.error = e
+            self.stop.set()
+            raise
+        finally:
+            if self.listener is not None:
+                self.listener.close()
+            if self.backfill:
+                for alias in self.aliases:
+                    get_es_client().end_backfill(alias)
+
+
+class Scheduler:
+    """
+    Параллельная синхронизация: каждая стратегия работает в своем потоке со своим окном,
+    поэтому большой объем изменений одной сущности не задерживает остальные.
+
+    Одновременная нагрузка ограничивается общими ресурсами: размером пула соединений Postgres
+    и числом одновременных bulk-запросов в EsManagement.
+    """
+
+    def __init__(
+            self,
+            settings: Settings,
+            chain: Optional[Sequence[Type[ContentTableStrategyFabric]]] = None,
+            state: Optional[State] = None
+    ):
+        self.stop = threading.Event()
+        self.workers: List[Worker] = [
+            Worker(settings=settings, chain=(strategy,), stop=self.stop, state=state, restore_profile=False)
+            for strategy in chain or Manager.chain_for(settings)
+        ]
+
+    def run(self):
+        # до запуска потоков: иначе запустившийся позже воркер сбросил бы профиль, включенный другим
+        steady_profile({alias for worker in self.workers for alias in worker.aliases})
+        for worker in self.workers:
+            worker.start()
+        self.stop.wait()
+        for worker in self.workers:
+            worker.join()
+
+        failed = [worker for worker in self.workers if worker.error is not None]
+        for worker in failed:
+            logging.error('%s stopped: %s', worker.name, worker.error)
+        if failed:
+            raise failed[0].error
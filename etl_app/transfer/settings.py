@@ -1,10 +1,33 @@
 import datetime
+from enum import Enum
 from typing import Optional
 
 from psycopg2.extras import RealDictCursor
 from pydantic import BaseModel, Field
+from redis import Redis
 
-from .utils import backoff, postgres_connection
+from .hashes import BaseHashStore, FileHashStore, RedisHashStore
+from .state import JsonFileStorage, RedisStorage, State
+from .watermarks import earliest_update
+
+
+class EtlMode(str, Enum):
+    # постраничное извлечение с keyset-пагинацией
+    batch = 'batch'
+    # окно таблицы целиком через серверный курсор
+    stream = 'stream'
+    # извлечение, трансформация и загрузка в отдельных потоках
+    pipeline = 'pipeline'
+
+
+class StateStorage(str, Enum):
+    json = 'json'
+    redis = 'redis'
+
+
+class HashStorage(str, Enum):
+    file = 'file'
+    redis = 'redis'
 
 
 class Settings(BaseModel):
@@ -17,24 +40,79 @@ class Settings(BaseModel):
     cursor_factory = Field(default=RealDictCursor)
     date_end: datetime.datetime = Field(default_factory=datetime.datetime.now)
     date_start: Optional[datetime.datetime]
+    mode: EtlMode = Field(default=EtlMode.batch)
+    # размер порции, которую серверный курсор забирает из БД за раз
+    itersize: int = Field(default=2000)
+    # размер очередей между этапами конвейера, в пачках
+    pipeline_queue_size: int = Field(default=2)
+    # число процессов для трансформации пачек; 0 - трансформация в процессе ETL
+    transform_workers: int = Field(default=0)
+    # строк в порции, передаваемой процессу трансформации
+    transform_chunk_size: int = Field(default=500)
+    # длина окна в секундах, начиная с которой ETL считается догоняющим; 0 - профиль не переключается
+    backfill_threshold: int = Field(default=3600)
+    # стратегии работают параллельно, каждая в своем потоке
+    parallel: bool = Field(default=False)
+    # границы паузы между проходами по окну, в секундах
+    poll_min_interval: float = Field(default=1)
+    poll_max_interval: float = Field(default=30)
+    # переиндексация по уведомлениям триггеров (LISTEN/NOTIFY) вместо частого опроса окна
+    listen: bool = Field(default=False)
+    # документ фильма собирается целиком вместо трех частичных обновлений
+    merge_movies: bool = Field(default=False)
+    # документы собираются в JSON запросом к БД и уходят в bulk-запрос без разбора в Python
+    raw_json: bool = Field(default=False)
+    # каждая строка проходит валидацию pydantic (для отладки данных)
+    strict_validation: bool = Field(default=False)
+    # разовая начальная загрузка диапазонами id вместо синхронизации по времени
+    backfill: bool = Field(default=False)
+    backfill_partitions: int = Field(default=16)
+    backfill_workers: int = Field(default=4)
+    # разовая перестройка индексов в новые версии с переключением алиасов вместо синхронизации
+    rebuild: bool = Field(default=False)
+    # где хранится прогресс стратегий между перезапусками
+    state_storage: StateStorage = Field(default=StateStorage.json)
+    state_file_path: str = Field(default='state.json')
+    redis_host: str = Field(default='127.0.0.1')
+    redis_port: int = Field(default=6379)
+    # пропуск документов, содержимое которых не изменилось с прошлой отправки, и где хранятся их хэши
+    skip_unchanged: bool = Field(default=False)
+    hash_storage: HashStorage = Field(default=HashStorage.file)
+    hash_file_path: str = Field(default='hashes.db')
+    # создавать недостающие индексы (modified, id) при старте, а не только предупреждать о них
+    create_indexes: bool = Field(default=False)
+    pool_min_size: int = Field(default=1)
+    pool_max_size: int = Field(default=5)
+    # через сколько секунд простоя соединение проверяется перед выдачей из пула
+    pool_check_interval: int = Field(default=30)
+
+    @property
+    def dsn(self) -> dict:
+        return {
+            'dbname': self.dbname,
+            'user': self.user,
+            'password': self.password,
+            'host': self.host,
+            'port': self.port,
+            'cursor_factory': self.cursor_factory,
+            # tcp keepalive, чтобы разорванное соединение обнаруживалось, а не висело в пуле
+            'keepalives': 1,
+            'keepalives_idle': 30,
+            'keepalives_interval': 10,
+            'keepalives_count': 3,
+        }
+
+    def get_state(self) -> State:
+        if self.state_storage == StateStorage.redis:
+            return State(RedisStorage(Redis(host=self.redis_host, port=self.redis_port)))
+        return State(JsonFileStorage(self.state_file_path))
+
+    def get_hash_store(self) -> Optional[BaseHashStore]:
+        if not self.skip_unchanged:
+            return None
+        if self.hash_storage == HashStorage.redis:
+            return RedisHashStore(Redis(host=self.redis_host, port=self.redis_port))
+        return FileHashStore(self.hash_file_path)
 
-    @backoff(timeout_restriction=180, time_factor=2)
     def get_the_earliest_update(self) -> datetime.datetime:
-        with postgres_connection(
-                dbname=self.dbname,
-                user=self.user,
-                password=self.password,
-                host=self.host,
-                port=self.port,
-                cursor_factory=self.cursor_factory,
-        ) as conn, conn.cursor(cursor_factory=self.cursor_factory) as cur:
-            cur.execute(
-                """
-                -- если нет дат, то таблицы пустые и начинаем смотреть с текущей даты
-                select min(coalesce(fw.modified, g.modified, p.modified, now())) earliest_date from content.film_work fw 
-                full outer join "content".genre g on g.modified = fw.modified 
-                full outer join "content".person p  on p.modified = fw.modified;
-                """
-            )
-            earliest = cur.fetchone()
-        return earliest['earliest_date']
+        return earliest_update()
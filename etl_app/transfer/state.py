@@ -0,0 +1,72 @@
+import json
+import os
+import threading
+from abc import ABC, abstractmethod
+from typing import Any
+
+from redis import Redis
+
+
+class BaseStorage(ABC):
+    @abstractmethod
+    def save_state(self, state: dict) -> None:
+        """Сохранить состояние в постоянное хранилище"""
+        pass
+
+    @abstractmethod
+    def retrieve_state(self) -> dict:
+        """Загрузить состояние локально из постоянного хранилища"""
+        pass
+
+
+class JsonFileStorage(BaseStorage):
+    def __init__(self, file_path: str = 'state.json'):
+        self.file_path = file_path
+
+    def save_state(self, state: dict) -> None:
+        # запись через временный файл, чтобы падение посреди записи не испортило состояние
+        tmp_path = f'{self.file_path}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(state, f)
+        os.replace(tmp_path, self.file_path)
+
+    def retrieve_state(self) -> dict:
+        if not os.path.exists(self.file_path):
+            return {}
+        with open(self.file_path) as f:
+            return json.load(f)
+
+
+class RedisStorage(BaseStorage):
+    def __init__(self, redis_adapter: Redis, key: str = 'etl_state'):
+        self.redis_adapter = redis_adapter
+        self.key = key
+
+    def save_state(self, state: dict) -> None:
+        self.redis_adapter.set(self.key, json.dumps(state))
+
+    def retrieve_state(self) -> dict:
+        raw = self.redis_adapter.get(self.key)
+        return json.loads(raw) if raw else {}
+
+
+class State:
+    """
+    Класс для хранения состояния при работе с данными, чтобы постоянно не перечитывать данные с начала.
+    Состояние хранится в памяти и сохраняется в хранилище при каждом изменении.
+    """
+
+    def __init__(self, storage: BaseStorage):
+        self.storage = storage
+        self.state = storage.retrieve_state()
+        self._lock = threading.Lock()
+
+    def set_state(self, key: str, value: Any) -> None:
+        """Установить состояние для определённого ключа"""
+        with self._lock:
+            self.state[key] = value
+            self.storage.save_state(self.state)
+
+    def get_state(self, key: str) -> Any:
+        """Получить состояние по определённому ключу"""
+        return self.state.get(key)
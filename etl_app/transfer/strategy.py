@@ -1,15 +1,19 @@
 import datetime
-import os
+import uuid
 from abc import ABC, abstractmethod
-from typing import Generator, Iterator, List, Type, Union
+from typing import (Collection, Dict, Generator, Iterable, Iterator, List,
+                    Optional, Set, Tuple, Type, Union)
 
-from psycopg2 import OperationalError, extras
-from psycopg2._psycopg import cursor as psy_cursor
+from psycopg2 import OperationalError, extensions, extras
 
-from .elastic import EsManagement
-from .utils import backoff, postgres_connection
+from .elastic import BulkStats, EsManagement, get_es_client
+from .fanout import FanOut
+from .hashes import ChangedDocuments, get_store
+from .postgres import get_pool
+from .utils import backoff
 from .validators import (FilmWorkTableSchema, GenrePostgreRow,
-                         GenreTableSchema, PersonPostgreRow, PersonTableSchema)
+                         GenreTableSchema, MovieSchema, PersonPostgreRow,
+                         PersonTableSchema, Position, compile_serializer)
 
 
 class ContentTableStrategyFabric(ABC):
@@ -17,227 +21,640 @@ class ContentTableStrategyFabric(ABC):
 
     schema = 'content'
     table_name: str = None
-    es_client = EsManagement()
     es_index = 'movies'
+    # update - стратегия пишет часть полей документа, index - документ целиком
+    es_op_type = 'update'
+    # обратные зависимости: стратегия обновляет фильмы, связанные с измененной сущностью
+    fanout: Optional[FanOut] = None
+    # таблицы, об изменениях которых сообщают триггеры, и запрос, переводящий id их строк в id документов;
+    # None - id строки совпадает с id документа
+    notify_tables: Dict[str, Optional[str]] = {}
+    # таблицы, по modified которых стратегия выбирает окна; по ним ищется начало первого окна
+    modified_tables: Tuple[str, ...] = ('film_work', 'genre', 'person')
+    # таблица, id строк которой совпадают с id документов индекса: по ней делится начальная загрузка
+    # и проверяется, что строка документа удалена
+    range_table = 'film_work'
+    # колонки ключа keyset-пагинации, по которым упорядочен запрос
+    keyset: Tuple[str, ...] = ('modified', 'id')
+
+    def __init__(self, raw_json: bool = False, strict_validation: bool = False):
+        # документы собираются в JSON запросом к БД и уходят в bulk-запрос без разбора в Python
+        self.raw_json = raw_json
+        # строгий режим: каждая строка проходит валидацию pydantic (для отладки данных)
+        self.strict_validation = strict_validation
+
+    @property
+    def es_client(self) -> EsManagement:
+        # клиент создается при первой загрузке: импорт стратегий не обращается к кластеру
+        return get_es_client()
 
     @property
     @abstractmethod
     def validator(self) -> Type[Union[FilmWorkTableSchema, PersonTableSchema, GenreTableSchema]]:
         pass
 
-    @backoff(timeout_restriction=180, time_factor=2, exception=OperationalError)
     def extract(
             self,
             reference_date_start: datetime.datetime,
             reference_date_end: datetime.datetime,
             query_limit: int,
-            offset: int
+            position: Optional[Position] = None
     ) -> List[dict]:
-        """Основной метод, отвечающий за извлечение данных"""
-        with postgres_connection(
-                dbname=os.environ.get('DB_NAME'),
-                user=os.environ.get('DB_USER'),
-                password=os.environ.get('DB_PASSWORD'),
-                host=os.environ.get('DB_HOST', '127.0.0.1'),
-                port=os.environ.get('DB_PORT', 5432),
-                cursor_factory=extras.RealDictCursor
-        ) as conn, conn.cursor(cursor_factory=extras.RealDictCursor) as cursor:
-            self.strategy_extra_query(
-                cursor=cursor,
+        """Основной метод, отвечающий за извлечение данных: очередная страница после ключа position"""
+        columns, rows = self.extract_rows(
+            reference_date_start=reference_date_start,
+            reference_date_end=reference_date_end,
+            query_limit=query_limit,
+            position=position
+        )
+        return [dict(zip(columns, row)) for row in rows]
+
+    @backoff(timeout_restriction=180, time_factor=2, exception=OperationalError)
+    def extract_rows(
+            self,
+            reference_date_start: datetime.datetime,
+            reference_date_end: datetime.datetime,
+            query_limit: int,
+            position: Optional[Position] = None
+    ) -> Tuple[Tuple[str, ...], List[tuple]]:
+        """Та же страница, что и в extract, но колонками и кортежами значений - для передачи в другие процессы"""
+        return self.fetch(
+            self.query(),
+            self.query_params(
                 reference_date_start=reference_date_start,
                 reference_date_end=reference_date_end,
                 query_limit=query_limit,
-                offset=offset
+                position=position
             )
-            return cursor.fetchall()
+        )
 
-    def transform(self, queryset: List[dict]) -> Generator:
-        """
-        Логика трансформации результатов запроса обновленных данных под схему elasticsearch при обновлении результатов
+    @backoff(timeout_restriction=180, time_factor=2, exception=OperationalError)
+    def extract_ids(self, ids: Collection[str]) -> List[dict]:
+        """Извлечение данных для документов с заданными id, без временного окна"""
+        columns, rows = self.fetch(self.ids_query(), {'ids': list(ids)})
+        return [dict(zip(columns, row)) for row in rows]
+
+    @staticmethod
+    def fetch(sql: str, params: dict) -> Tuple[Tuple[str, ...], List[tuple]]:
+        """Результат запроса колонками и кортежами значений"""
+        with get_pool().connection() as conn, conn.cursor(cursor_factory=extensions.cursor) as cursor:
+            cursor.execute(sql, params)
+            return tuple(column.name for column in cursor.description), cursor.fetchall()
+
+    @backoff(timeout_restriction=180, time_factor=2, exception=OperationalError)
+    def affected_ids(self, changes: Dict[str, Set[str]]) -> Set[str]:
+        """id документов индекса, затронутых изменениями строк таблиц БД"""
+        ids = set()
+        with get_pool().connection() as conn, conn.cursor(cursor_factory=extensions.cursor) as cursor:
+            for table, sql in self.notify_tables.items():
+                changed = changes.get(table)
+                if not changed:
+                    continue
+                if sql is None:
+                    ids.update(changed)
+                    continue
+                cursor.execute(sql, {'ids': list(changed)})
+                ids.update(str(row[0]) for row in cursor.fetchall())
+        return ids
+
+    @backoff(timeout_restriction=180, time_factor=2, exception=OperationalError)
+    def missing_ids(self, ids: Collection[str]) -> List[str]:
+        """id из ids, строк которых больше нет в range_table: документы удаленных строк"""
+        with get_pool().connection() as conn, conn.cursor(cursor_factory=extensions.cursor) as cursor:
+            cursor.execute(
+                f'SELECT id FROM {self.schema}.{self.range_table} WHERE id = ANY(%(ids)s::uuid[])',
+                {'ids': list(ids)}
+            )
+            existing = {str(row[0]) for row in cursor.fetchall()}
+        return [id_ for id_ in ids if id_ not in existing]
+
+    @backoff(timeout_restriction=180, time_factor=2, exception=OperationalError)
+    def range_ids(
+            self,
+            lower: uuid.UUID,
+            upper: Optional[uuid.UUID],
+            position: Optional[uuid.UUID],
+            query_limit: int
+    ) -> List[str]:
+        """Страница id документов из диапазона [lower, upper) после position, по возрастанию id"""
+        with get_pool().connection() as conn, conn.cursor(cursor_factory=extensions.cursor) as cursor:
+            cursor.execute(
+                f"""
+                SELECT id
+                FROM {self.schema}.{self.range_table}
+                WHERE id >= %(lower)s::uuid
+                    AND (%(upper)s::uuid IS NULL OR id < %(upper)s::uuid)
+                    AND (%(position)s::uuid IS NULL OR id > %(position)s::uuid)
+                ORDER BY id
+                LIMIT %(limit)s
+                """,
+                {
+                    'lower': str(lower),
+                    'upper': upper and str(upper),
+                    'position': position and str(position),
+                    'limit': query_limit,
+                }
+            )
+            return [str(row[0]) for row in cursor.fetchall()]
+
+    def stream(
+            self,
+            reference_date_start: datetime.datetime,
+            reference_date_end: datetime.datetime,
+            itersize: int
+    ) -> Iterator[dict]:
         """
+        Потоковое извлечение всего временного окна одним запросом.
 
-        return (self.validator(**row).dict(by_alias=True) for row in queryset)
+        Строки читаются серверным (именованным) курсором порциями по itersize,
+        поэтому память ограничена размером порции, а не объемом окна.
+        """
+        with get_pool().connection() as conn, conn.cursor(
+                name=f'etl_{self.table_name}_{uuid.uuid4().hex}',
+                cursor_factory=extras.RealDictCursor
+        ) as cursor:
+            cursor.itersize = itersize
+            cursor.execute(
+                self.query(),
+                self.query_params(
+                    reference_date_start=reference_date_start,
+                    reference_date_end=reference_date_end,
+                    query_limit=None
+                )
+            )
+            yield from cursor
 
-    @abstractmethod
-    def strategy_extra_query(
+    def query_params(
             self,
-            cursor: psy_cursor,
             reference_date_start: datetime.datetime,
             reference_date_end: datetime.datetime,
-            query_limit: int,
-            offset: int
-    ) -> str:
-        """Логика извлечения данных для конкретной таблицы"""
+            query_limit: Optional[int],
+            position: Optional[Position] = None
+    ) -> dict:
+        """Параметры запроса: временное окно и ключ, с которого начинается страница; LIMIT NULL - без ограничения"""
+        position = position or Position(modified=reference_date_start)
+        return {
+            'date_start': reference_date_start,
+            'date_end': reference_date_end,
+            'limit': query_limit,
+            'modified': position.modified,
+            'id': str(position.id),
+        }
+
+    def position(self, row: dict) -> Position:
+        """Ключ keyset-пагинации для последней строки страницы"""
+        return Position(**{column: row[column] for column in self.keyset})
+
+    def query(self) -> str:
+        return self.json_query(self.strategy_extra_query()) if self.raw_json else self.strategy_extra_query()
+
+    def ids_query(self) -> str:
+        return self.json_query(self.strategy_ids_query()) if self.raw_json else self.strategy_ids_query()
+
+    def json_query(self, sql: str) -> str:
+        """Запрос стратегии, отдающий вместо строк ключ пагинации и готовый документ Elasticsearch текстом"""
+        keyset = ', '.join(f'q.{column}' for column in self.keyset)
+        return f"""
+                SELECT {keyset}, ({self.document_json('q')})::text as es_document
+                FROM ({sql.strip().rstrip(';')}) q
+                ORDER BY {keyset};
+                """
+
+    def document_json(self, alias: str) -> str:
+        """SQL-выражение документа индекса из строки запроса стратегии: поля схемы validator по именам колонок"""
+        pairs = ', '.join(f"'{field}', {alias}.{field}" for field in self.validator.__fields__)
+        return f'json_build_object({pairs})'
+
+    def transform(self, queryset: Iterable[dict]) -> Generator:
+        """
+        Логика трансформации результатов запроса обновленных данных под схему elasticsearch при обновлении результатов
+        """
+        if self.raw_json:
+            return ((row['id'], row['es_document']) for row in queryset)
+        return (self.serialize(row) for row in queryset)
+
+    def serialize(self, row: dict) -> dict:
+        """
+        Строка БД в документ: в строгом режиме через валидацию схемой,
+        иначе скомпилированным сериализатором схемы без валидации
+        """
+        if self.strict_validation:
+            return self.validator(**row).dict(by_alias=True)
+        return compile_serializer(self.validator, by_alias=True)(row)
+
+    @abstractmethod
+    def strategy_extra_query(self) -> str:
+        """
+        Логика извлечения данных для конкретной таблицы.
+
+        Запрос упорядочен по ключу пагинации и начинается строго после него:
+        %(date_start)s и %(date_end)s - временное окно, %(modified)s и %(id)s - ключ последней строки
+        предыдущей страницы, %(limit)s - размер страницы.
+        """
         pass
 
+    @abstractmethod
+    def strategy_ids_query(self) -> str:
+        """Те же данные, что и в strategy_extra_query, но для документов с id из %(ids)s"""
+        pass
+
+    def bulk(self, qs: Iterable, skip_unchanged: bool = True) -> BulkStats:
+        """
+        Запись документов в индекс стратегии. Если включено хранилище хэшей, документы с тем же
+        содержимым, что и при прошлой отправке, пропускаются. При перестройке индекса новая версия
+        пуста, поэтому отправляются все документы. Без skip_unchanged отправляются все документы,
+        но их хэши сохраняются для следующих загрузок.
+        """
+        store = get_store()
+        if store is None or self.es_index in self.es_client.targets:
+            return self.send(qs)
+
+        # стратегии одного индекса пишут разные части документа, поэтому хэши у каждой свои;
+        # хэши относятся к версии индекса за алиасом: у заново созданного индекса их еще нет
+        index = self.es_client.physical_index(self.es_index)
+        changed = ChangedDocuments(store, key=f'{index}:{self.__class__.__name__}', skip=skip_unchanged)
+        stats = self.send(changed.filter(qs))
+        stats.skipped = changed.skipped
+        # какие именно документы не записались, неизвестно: хэши сохраняются только после полной загрузки
+        if not stats.failed:
+            changed.commit()
+        return stats
+
+    def send(self, qs: Iterable) -> BulkStats:
+        if self.raw_json:
+            return self.es_client.upsert_raw(documents=qs, index=self.es_index, op_type=self.es_op_type)
+        return self.es_client.upsert(query_set=qs, index=self.es_index, op_type=self.es_op_type)
+
+    @backoff(timeout_restriction=180, time_factor=2)
+    def load(self, qs: Iterator[dict], skip_unchanged: bool = True):
+        return self.bulk(qs, skip_unchanged=skip_unchanged)
+
     @backoff(timeout_restriction=180, time_factor=2)
-    def load(self, qs: Iterator[dict]):
-        return self.es_client.upsert(query_set=qs, index=self.es_index)
+    def delete(self, ids: Collection[str]) -> BulkStats:
+        return self.es_client.delete(index=self.es_index, ids=ids)
+
+    @backoff(timeout_restriction=180, time_factor=2)
+    def stream_load(
+            self,
+            reference_date_start: datetime.datetime,
+            reference_date_end: datetime.datetime,
+            itersize: int
+    ):
+        """Извлечение, трансформация и загрузка окна единым потоком; при сбое окно повторяется целиком"""
+        rows = self.stream(
+            reference_date_start=reference_date_start,
+            reference_date_end=reference_date_end,
+            itersize=itersize
+        )
+        return self.bulk(self.transform(rows))
 
 
 class FilmWorkTableStrategyFabric(ContentTableStrategyFabric):
     table_name = 'film_work'
+    modified_tables = ('film_work',)
+    notify_tables = {'film_work': None}
 
     @property
     def validator(self) -> Type[FilmWorkTableSchema]:
         return FilmWorkTableSchema
 
-    def strategy_extra_query(
-            self,
-            cursor: psy_cursor,
-            reference_date_start: datetime.datetime,
-            reference_date_end: datetime.datetime,
-            query_limit: int,
-            offset: int
-    ):
-        sql = f"""
+    def strategy_extra_query(self) -> str:
+        return f"""
                 SELECT
                     id,
                     rating as imdb_rating,
                     title,
-                    description
+                    description,
+                    modified
                 FROM {self.schema}.{self.table_name}
-                WHERE modified BETWEEN '{reference_date_start}' AND '{reference_date_end}'
-                offset({offset})
-                limit ({query_limit});
+                WHERE modified BETWEEN %(date_start)s AND %(date_end)s
+                    AND (modified, id) > (%(modified)s, %(id)s::uuid)
+                ORDER BY modified, id
+                LIMIT %(limit)s;
+                """
+
+    def strategy_ids_query(self) -> str:
+        return f"""
+                SELECT
+                    id,
+                    rating as imdb_rating,
+                    title,
+                    description,
+                    modified
+                FROM {self.schema}.{self.table_name}
+                WHERE id = ANY(%(ids)s::uuid[]);
                 """
-        cursor.execute(sql)
 
 
 class GenreTableStrategyFabric(ContentTableStrategyFabric):
+    """Поле genre фильмов, связанных с измененными жанрами"""
+
     table_name = 'genre'
+    modified_tables = ('genre',)
+    fanout = FanOut(source_table='genre', link_table='genre_film_work', link_column='genre_id')
+    notify_tables = {
+        'genre': fanout.ids_query(),
+        'genre_film_work': None,
+    }
+    # строки агрегированы по фильму, поэтому страницы идут по id фильма внутри окна
+    keyset = ('id',)
 
     @property
     def validator(self) -> Type[GenreTableSchema]:
         return GenreTableSchema
 
-    def strategy_extra_query(
-            self,
-            cursor: psy_cursor,
-            reference_date_start,
-            reference_date_end,
-            query_limit: int,
-            offset: int
-    ):
-        sql = f"""
-                SELECT pfw.film_work_id id, array_agg(source.name) as genre
-                FROM {self.schema}.{self.table_name} source
-                JOIN {self.schema}.genre_film_work pfw ON pfw.genre_id = source.id
-                WHERE source.modified BETWEEN '{reference_date_start}' AND '{reference_date_end}'
-                GROUP BY pfw.film_work_id
-                offset ({offset})
-                limit ({query_limit});
+    def fields_query(self, changed: str) -> str:
+        """Полный список жанров для фильмов из подзапроса changed; фильм без жанров получает пустой список"""
+        return f"""
+                WITH changed AS ({changed})
+                SELECT
+                    changed.id,
+                    COALESCE (
+                        (
+                            SELECT array_agg(source.name)
+                            FROM {self.schema}.genre_film_work pfw
+                            JOIN {self.schema}.{self.table_name} source ON source.id = pfw.genre_id
+                            WHERE pfw.film_work_id = changed.id
+                        ),
+                        '{{}}'
+                    ) as genre
+                FROM changed
+                ORDER BY changed.id;
                 """
-        cursor.execute(sql)
+
+    def strategy_extra_query(self) -> str:
+        return self.fields_query(self.fanout.window_query())
+
+    def strategy_ids_query(self) -> str:
+        # только существующие фильмы: частичный документ удаленного фильма воссоздал бы его заглушкой
+        return self.fields_query(f'SELECT id FROM {self.schema}.film_work WHERE id = ANY(%(ids)s::uuid[])')
 
 
 class PersonTableStrategyFabric(ContentTableStrategyFabric):
+    """Поля участников фильмов, связанных с измененными персонами"""
+
     table_name = 'person'
+    modified_tables = ('person',)
+    fanout = FanOut(source_table='person', link_table='person_film_work', link_column='person_id')
+    notify_tables = {
+        'person': fanout.ids_query(),
+        'person_film_work': None,
+    }
+    # строки агрегированы по фильму, поэтому страницы идут по id фильма внутри окна
+    keyset = ('id',)
 
     @property
     def validator(self) -> Type[PersonTableSchema]:
         return PersonTableSchema
 
-    def strategy_extra_query(
-            self,
-            cursor: psy_cursor,
-            reference_date_start: datetime.datetime,
-            reference_date_end: datetime.datetime,
-            query_limit: int,
-            offset: int
-    ):
-        sql = f"""
+    def fields_query(self, changed: str) -> str:
+        """Полный состав фильмов из подзапроса changed; фильм без участников получает пустые списки"""
+        return f"""
+                WITH changed AS ({changed})
                 SELECT
-                    source.film_work_id id,
+                    changed.id,
                     COALESCE (
-                        json_agg(
-                            DISTINCT jsonb_build_object(
-                                'person_role', source.role,
-                                'person_id', persons.id,
-                                'person_name', persons.full_name
+                        (
+                            SELECT json_agg(
+                                DISTINCT jsonb_build_object(
+                                    'person_role', source.role,
+                                    'person_id', persons.id,
+                                    'person_name', persons.full_name
+                                )
                             )
-                        ) FILTER (WHERE persons.id is not null),
+                            FROM {self.schema}.person_film_work source
+                            JOIN {self.schema}.{self.table_name} persons ON persons.id = source.person_id
+                            WHERE source.film_work_id = changed.id
+                        ),
                         '[]'
                     ) as persons
-                FROM content.person_film_work source
-                JOIN (
-                    SELECT distinct pfw.film_work_id
-                    FROM content.person_film_work pfw
-                    JOIN  (
-                        SELECT id FROM content.person
-                        WHERE modified BETWEEN '{reference_date_start}' AND '{reference_date_end}'
-                    ) updated on updated.id = pfw.person_id
-                ) sub ON sub.film_work_id = source.film_work_id
-                JOIN content.person persons ON persons.id = source.person_id
-                GROUP BY source.film_work_id
-                offset ({offset})
-                limit ({query_limit});
+                FROM changed
+                ORDER BY changed.id;
                 """
-        cursor.execute(sql)
 
-    def transform(self, queryset: List[dict]):
-        for row in queryset:
-            line = self.validator(id=row['id']).dict()
-            for person in row['persons']:
-                if person['person_role'] == 'director':
-                    line['director'] = person['person_name']
-                else:
-                    line[f'{person["person_role"]}s'].append(
-                        {'name': person["person_name"], 'id': person["person_id"]}
-                    )
-                    line[f'{person["person_role"]}s_names'].append(person["person_name"])
+    def strategy_extra_query(self) -> str:
+        return self.fields_query(self.fanout.window_query())
+
+    def strategy_ids_query(self) -> str:
+        # только существующие фильмы: частичный документ удаленного фильма воссоздал бы его заглушкой
+        return self.fields_query(f'SELECT id FROM {self.schema}.film_work WHERE id = ANY(%(ids)s::uuid[])')
+
+    @staticmethod
+    def fill_persons(line: dict, persons: List[dict]):
+        """Раскладка участников фильма по полям документа в зависимости от роли"""
+        for person in persons:
+            if person['person_role'] == 'director':
+                line['director'] = person['person_name']
+            else:
+                line[f'{person["person_role"]}s'].append(
+                    {'name': person["person_name"], 'id': person["person_id"]}
+                )
+                line[f'{person["person_role"]}s_names'].append(person["person_name"])
+
+    @staticmethod
+    def persons_json(persons: str) -> str:
+        """
+        Пары ключ-значение json_build_object с полями участников из JSON-массива persons:
+        та же раскладка, что в fill_persons, но на стороне БД
+        """
+        def by_role(role: str, value: str) -> str:
+            return (
+                f"COALESCE((SELECT json_agg({value}) FROM json_array_elements({persons}) person "
+                f"WHERE person ->> 'person_role' = '{role}'), '[]')"
+            )
+
+        nested = "json_build_object('id', person -> 'person_id', 'name', person -> 'person_name')"
+        name = "person -> 'person_name'"
+        director = (
+            f"(SELECT person ->> 'person_name' FROM json_array_elements({persons}) person "
+            f"WHERE person ->> 'person_role' = 'director' LIMIT 1)"
+        )
+        return ', '.join((
+            f"'director', {director}",
+            f"'actors', {by_role('actor', nested)}",
+            f"'actors_names', {by_role('actor', name)}",
+            f"'writers', {by_role('writer', nested)}",
+            f"'writers_names', {by_role('writer', name)}",
+        ))
+
+    def document_json(self, alias: str) -> str:
+        return f"json_build_object('id', {alias}.id, {self.persons_json(f'{alias}.persons')})"
+
+    def serialize(self, row: dict) -> dict:
+        line = compile_serializer(self.validator)({'id': row['id']})
+        self.fill_persons(line, row['persons'])
+        return self.validator(**line).dict() if self.strict_validation else line
+
+
+class MovieTableStrategyFabric(ContentTableStrategyFabric):
+    """
+    Полный документ фильма одним запросом: фильм, его жанры и участники.
+
+    В окно попадают фильмы, у которых изменились сами данные, связанные жанры или персоны,
+    и каждый такой фильм записывается в индекс одной операцией вместо трех частичных обновлений.
+    """
+
+    table_name = 'film_work'
+    modified_tables = ('film_work', 'genre', 'person')
+    es_op_type = 'index'
+    notify_tables = {
+        'film_work': None,
+        'genre': GenreTableStrategyFabric.fanout.ids_query(),
+        'person': PersonTableStrategyFabric.fanout.ids_query(),
+        'genre_film_work': None,
+        'person_film_work': None,
+    }
+    # документы собираются по фильму, поэтому страницы идут по id фильма внутри окна
+    keyset = ('id',)
+
+    @property
+    def validator(self) -> Type[MovieSchema]:
+        return MovieSchema
+
+    def document_query(self, changed: str) -> str:
+        """Сборка документов для фильмов из подзапроса changed"""
+        return f"""
+                WITH changed AS ({changed})
+                SELECT
+                    fw.id,
+                    fw.rating as imdb_rating,
+                    fw.title,
+                    fw.description,
+                    COALESCE (
+                        (
+                            SELECT array_agg(g.name)
+                            FROM {self.schema}.genre_film_work gfw
+                            JOIN {self.schema}.genre g ON g.id = gfw.genre_id
+                            WHERE gfw.film_work_id = fw.id
+                        ),
+                        '{{}}'
+                    ) as genre,
+                    COALESCE (
+                        (
+                            SELECT json_agg(
+                                json_build_object(
+                                    'person_role', pfw.role,
+                                    'person_id', p.id,
+                                    'person_name', p.full_name
+                                )
+                            )
+                            FROM {self.schema}.person_film_work pfw
+                            JOIN {self.schema}.person p ON p.id = pfw.person_id
+                            WHERE pfw.film_work_id = fw.id
+                        ),
+                        '[]'
+                    ) as persons
+                FROM changed
+                JOIN {self.schema}.film_work fw ON fw.id = changed.id
+                ORDER BY fw.id;
+                """
 
-            validated = self.validator(**line).dict()
-            yield validated
+    def strategy_extra_query(self) -> str:
+        return self.document_query(f"""
+                    SELECT id FROM (
+                        SELECT fw.id
+                        FROM {self.schema}.film_work fw
+                        WHERE fw.modified BETWEEN %(date_start)s AND %(date_end)s
+                        UNION
+                        SELECT gfw.film_work_id
+                        FROM {self.schema}.genre_film_work gfw
+                        JOIN {self.schema}.genre g ON g.id = gfw.genre_id
+                        WHERE g.modified BETWEEN %(date_start)s AND %(date_end)s
+                        UNION
+                        SELECT pfw.film_work_id
+                        FROM {self.schema}.person_film_work pfw
+                        JOIN {self.schema}.person p ON p.id = pfw.person_id
+                        WHERE p.modified BETWEEN %(date_start)s AND %(date_end)s
+                    ) updated
+                    WHERE id > %(id)s::uuid
+                    ORDER BY id
+                    LIMIT %(limit)s
+                """)
+
+    def strategy_ids_query(self) -> str:
+        return self.document_query('SELECT unnest(%(ids)s::uuid[]) id')
+
+    def document_json(self, alias: str) -> str:
+        return f"""json_build_object(
+                    'id', {alias}.id,
+                    'imdb_rating', {alias}.imdb_rating,
+                    'title', {alias}.title,
+                    'description', {alias}.description,
+                    'genre', {alias}.genre,
+                    {PersonTableStrategyFabric.persons_json(f'{alias}.persons')}
+                )"""
+
+    def serialize(self, row: dict) -> dict:
+        line = compile_serializer(self.validator)(row)
+        PersonTableStrategyFabric.fill_persons(line, row['persons'])
+        return self.validator(**line).dict() if self.strict_validation else line
 
 
 class GenreTableStrategyGenreIndexFabric(ContentTableStrategyFabric):
     table_name = 'genre'
+    modified_tables = ('genre',)
     es_index = 'genres'
+    notify_tables = {'genre': None}
+    range_table = 'genre'
 
     @property
     def validator(self) -> Type[GenrePostgreRow]:
         return GenrePostgreRow
 
-    def strategy_extra_query(
-            self,
-            cursor: psy_cursor,
-            reference_date_start,
-            reference_date_end,
-            query_limit: int,
-            offset: int
-    ):
-        sql = f"""
-                SELECT source.id, source.name, source.description
+    def serialize(self, row: dict) -> dict:
+        doc = super().serialize(row)
+        # то же, что GenrePostgreRow.default_desc, для пути без валидации
+        doc['description'] = doc['description'] or 'No description'
+        return doc
+
+    def document_json(self, alias: str) -> str:
+        return (
+            f"json_build_object('id', {alias}.id, 'name', {alias}.name, "
+            f"'description', COALESCE(NULLIF({alias}.description, ''), 'No description'))"
+        )
+
+    def strategy_extra_query(self) -> str:
+        return f"""
+                SELECT source.id, source.name, source.description, source.modified
+                FROM {self.schema}.{self.table_name} source
+                WHERE source.modified BETWEEN %(date_start)s AND %(date_end)s
+                    AND (source.modified, source.id) > (%(modified)s, %(id)s::uuid)
+                ORDER BY source.modified, source.id
+                LIMIT %(limit)s;
+                """
+
+    def strategy_ids_query(self) -> str:
+        return f"""
+                SELECT source.id, source.name, source.description, source.modified
                 FROM {self.schema}.{self.table_name} source
-                WHERE source.modified BETWEEN '{reference_date_start}' AND '{reference_date_end}'
-                offset ({offset})
-                limit ({query_limit});
+                WHERE source.id = ANY(%(ids)s::uuid[]);
                 """
-        cursor.execute(sql)
 
 
 class PersonTableStrategyPersonIndexFabric(ContentTableStrategyFabric):
     table_name = 'person'
+    modified_tables = ('person',)
     es_index = 'persons'
+    notify_tables = {'person': None}
+    range_table = 'person'
 
     @property
     def validator(self) -> Type[PersonPostgreRow]:
         return PersonPostgreRow
 
-    def strategy_extra_query(
-            self,
-            cursor: psy_cursor,
-            reference_date_start,
-            reference_date_end,
-            query_limit: int,
-            offset: int
-    ):
-        sql = f"""
-                SELECT source.id, source.full_name
+    def strategy_extra_query(self) -> str:
+        return f"""
+                SELECT source.id, source.full_name, source.modified
+                FROM {self.schema}.{self.table_name} source
+                WHERE source.modified BETWEEN %(date_start)s AND %(date_end)s
+                    AND (source.modified, source.id) > (%(modified)s, %(id)s::uuid)
+                ORDER BY source.modified, source.id
+                LIMIT %(limit)s;
+                """
+
+    def strategy_ids_query(self) -> str:
+        return f"""
+                SELECT source.id, source.full_name, source.modified
                 FROM {self.schema}.{self.table_name} source
-                WHERE source.modified BETWEEN '{reference_date_start}' AND '{reference_date_end}'
-                offset ({offset})
-                limit ({query_limit});
+                WHERE source.id = ANY(%(ids)s::uuid[]);
                 """
-        cursor.execute(sql)
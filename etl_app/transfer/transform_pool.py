@@ -0,0 +1,120 @@
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, Optional, Sequence, Tuple, Type
+
+from pydantic import BaseModel
+
+from .strategy import ContentTableStrategyFabric
+
+# экземпляры стратегий в процессе-воркере по классу и режиму валидации, создаются при первой пачке
+_strategies: Dict[Tuple[Type[ContentTableStrategyFabric], bool], ContentTableStrategyFabric] = {}
+
+
+class WorkerStats(BaseModel):
+    """Производительность одного процесса трансформации"""
+    pid: int
+    rows: int = 0
+    chunks: int = 0
+    # время трансформации без передачи данных между процессами
+    busy_s: float = 0
+
+    @property
+    def rows_per_sec(self) -> float:
+        return self.rows / self.busy_s if self.busy_s else 0
+
+    def __str__(self):
+        return f'pid {self.pid}: {self.rows} rows in {self.chunks} chunks, {self.rows_per_sec:.0f} rows/s'
+
+
+def _transform_chunk(
+        strategy: Type[ContentTableStrategyFabric],
+        strict_validation: bool,
+        columns: Sequence[str],
+        rows: List[tuple]
+) -> Tuple[int, List[dict], float]:
+    """Трансформация порции строк в процессе-воркере: строки приходят кортежами и собираются в словари здесь"""
+    started = time.monotonic()
+    table = _strategies.get((strategy, strict_validation))
+    if table is None:
+        table = _strategies[strategy, strict_validation] = strategy(strict_validation=strict_validation)
+    docs = [table.serialize(dict(zip(columns, row))) for row in rows]
+    return os.getpid(), docs, time.monotonic() - started
+
+
+class TransformPool:
+    """
+    Трансформация пачки в пуле процессов, чтобы валидация и подготовка документов занимали все ядра.
+
+    Пачка делится на порции по chunk_size строк; строки передаются кортежами с общим списком колонок,
+    а не словарями RealDictCursor, поэтому сериализация между процессами не съедает выигрыш.
+
+    Пул один на все стратегии и создается до запуска их потоков: все процессы-воркеры порождаются
+    сразу, пока fork не может скопировать блокировку, захваченную другим потоком (пула соединений,
+    logging, urllib3).
+    """
+
+    def __init__(self, workers: int, chunk_size: int = 500):
+        self.workers = workers
+        self.chunk_size = chunk_size
+        self.executor = ProcessPoolExecutor(max_workers=workers)
+        self.stats: Dict[int, WorkerStats] = {}
+        self._lock = threading.Lock()
+        # executor порождает процессы при первых задачах: по задаче на воркер запускает их все
+        for future in [self.executor.submit(os.getpid) for _ in range(workers)]:
+            future.result()
+
+    @staticmethod
+    def pack(rows: Sequence[dict]) -> Tuple[Tuple[str, ...], List[tuple]]:
+        """Строки-словари в общий список колонок и кортежи значений"""
+        if not rows:
+            return (), []
+        columns = tuple(rows[0])
+        return columns, [tuple(row.values()) for row in rows]
+
+    def transform(
+            self,
+            strategy: ContentTableStrategyFabric,
+            columns: Sequence[str],
+            rows: List[tuple]
+    ) -> List[dict]:
+        """Документы для пачки строк в исходном порядке"""
+        chunks = [rows[i:i + self.chunk_size] for i in range(0, len(rows), self.chunk_size)]
+        futures = [
+            self.executor.submit(_transform_chunk, strategy.__class__, strategy.strict_validation, tuple(columns), chunk)
+            for chunk in chunks
+        ]
+        docs = []
+        for future in futures:
+            pid, chunk_docs, busy_s = future.result()
+            with self._lock:
+                stats = self.stats.setdefault(pid, WorkerStats(pid=pid))
+                stats.rows += len(chunk_docs)
+                stats.chunks += 1
+                stats.busy_s += busy_s
+            docs.extend(chunk_docs)
+        return docs
+
+    def transform_dicts(self, strategy: ContentTableStrategyFabric, rows: Sequence[dict]) -> List[dict]:
+        return self.transform(strategy, *self.pack(rows))
+
+    def report(self, name: str):
+        """Производительность воркеров с прошлого отчета, по всем стратегиям, которые пользуются пулом"""
+        with self._lock:
+            stats, self.stats = self.stats, {}
+        if not stats:
+            return
+        logging.info(
+            '%s transform workers: %s',
+            name, '; '.join(str(worker) for _, worker in sorted(stats.items()))
+        )
+
+
+# общий пул трансформации; None - трансформация в потоке стратегии
+pool: Optional[TransformPool] = None
+
+
+def get_transform_pool() -> Optional[TransformPool]:
+    return pool
@@ -1,11 +1,8 @@
 import logging
 import os
 import time
-from contextlib import contextmanager
 from typing import Type
 
-from psycopg2 import connect, extensions
-
 
 def backoff(timeout_restriction: int, time_factor: int, exception: Type[BaseException] = Exception):
     def decor(func):
@@ -26,11 +23,3 @@ def backoff(timeout_restriction: int, time_factor: int, exception: Type[BaseExce
             return result
         return wrapper
     return decor
-
-
-@contextmanager
-def postgres_connection(*args, **kwargs) -> extensions.connection:
-    conn = connect(*args, **kwargs)
-    yield conn
-    conn.commit()
-    conn.close()
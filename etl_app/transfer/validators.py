@@ -1,8 +1,24 @@
+import datetime
 import uuid
-from typing import List, Optional
+from functools import lru_cache
+from typing import Callable, List, Optional, Type
 
 from pydantic import BaseModel, Field, validator
 
+_MISSING = object()
+
+
+class Position(BaseModel):
+    """Ключ keyset-пагинации: последняя извлеченная пара (modified, id)"""
+    modified: Optional[datetime.datetime]
+    id: uuid.UUID = Field(default_factory=lambda: uuid.UUID(int=0))
+
+
+class Watermark(BaseModel):
+    """Сохраненный прогресс стратегии: начало текущего окна и ключ последней загруженной строки в нем"""
+    date_start: datetime.datetime
+    position: Optional[Position]
+
 
 class NestedNames(BaseModel):
     id: uuid.UUID
@@ -19,7 +35,6 @@ class FilmWorkTableSchema(BaseModel):
 class GenreTableSchema(BaseModel):
     id: uuid.UUID
     genre: Optional[List[str]]
-    description: Optional[str] = 'No description'
 
 
 class GenrePostgreRow(BaseModel):
@@ -44,3 +59,34 @@ class PersonTableSchema(BaseModel):
     writers_names: Optional[List[Optional[str]]] = Field(default_factory=list)
     actors: Optional[List[Optional[NestedNames]]] = Field(default_factory=list)
     writers: Optional[List[Optional[NestedNames]]] = Field(default_factory=list)
+
+
+class MovieSchema(PersonTableSchema, FilmWorkTableSchema):
+    """Полный документ индекса movies"""
+    genre: List[str] = Field(default_factory=list)
+
+
+@lru_cache(maxsize=None)
+def compile_serializer(model: Type[BaseModel], by_alias: bool = False) -> Callable[[dict], dict]:
+    """
+    Сериализатор доверенных строк БД без валидации.
+
+    Набор полей и значения по умолчанию берутся из схемы один раз, а строка превращается в документ
+    одним проходом по полям. Типы не приводятся и валидаторы схемы не вызываются - их логику
+    при необходимости повторяет стратегия.
+    """
+    plan = [
+        (field.name, field.alias if by_alias else field.name, field.default_factory, field.default)
+        for field in model.__fields__.values()
+    ]
+
+    def serialize(row: dict) -> dict:
+        doc = {}
+        for name, key, default_factory, default in plan:
+            value = row.get(name, _MISSING)
+            if value is _MISSING:
+                value = default_factory() if default_factory is not None else default
+            doc[key] = value
+        return doc
+
+    return serialize
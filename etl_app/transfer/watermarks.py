@@ -0,0 +1,60 @@
+import datetime
+import logging
+import re
+from typing import Sequence
+
+from psycopg2 import OperationalError, extensions
+
+from .postgres import get_pool
+from .utils import backoff
+
+# таблицы, по колонке modified которых стратегии выбирают временные окна
+MODIFIED_TABLES = ('film_work', 'genre', 'person')
+
+
+@backoff(timeout_restriction=180, time_factor=2, exception=OperationalError)
+def earliest_update(tables: Sequence[str] = MODIFIED_TABLES, schema: str = 'content') -> datetime.datetime:
+    """
+    Самое раннее изменение в таблицах без соединений: min(modified) каждой таблицы
+    читается с края индекса по modified, а LEAST пропускает NULL пустых таблиц
+    """
+    mins = ', '.join(f'(SELECT min(modified) FROM {schema}.{table})' for table in tables)
+    with get_pool().connection() as conn, conn.cursor(cursor_factory=extensions.cursor) as cursor:
+        # если нет дат, то таблицы пустые и начинаем смотреть с текущей даты
+        cursor.execute(f'SELECT LEAST({mins}, now())')
+        earliest = cursor.fetchone()[0]
+    # границы окон дальше берутся из datetime.now(), поэтому приводим к локальному времени без зоны
+    if earliest.tzinfo is None:
+        return earliest
+    return earliest.astimezone().replace(tzinfo=None)
+
+
+@backoff(timeout_restriction=180, time_factor=2, exception=OperationalError)
+def ensure_modified_indexes(create: bool = False, tables: Sequence[str] = MODIFIED_TABLES, schema: str = 'content'):
+    """
+    Индексы (modified, id), на которые опираются фильтры окон BETWEEN и keyset-пагинация стратегий.
+    Без create недостающие индексы только выводятся в лог вместе с командой создания.
+    """
+    with get_pool().connection() as conn, conn.cursor(cursor_factory=extensions.cursor) as cursor:
+        cursor.execute(
+            'SELECT tablename, indexdef FROM pg_indexes WHERE schemaname = %(schema)s AND tablename = ANY(%(tables)s)',
+            {'schema': schema, 'tables': list(tables)}
+        )
+        covered = {table for table, indexdef in cursor.fetchall() if re.search(r'USING \w+ \(modified[,)]', indexdef)}
+
+    for table in tables:
+        if table in covered:
+            continue
+        ddl = f'CREATE INDEX CONCURRENTLY IF NOT EXISTS {table}_modified_id_idx ON {schema}.{table} (modified, id)'
+        if not create:
+            logging.warning('%s.%s: no index on modified, every window scans the table; run: %s', schema, table, ddl)
+            continue
+        with get_pool().connection() as conn:
+            # CONCURRENTLY не блокирует запись в таблицу, но не работает внутри транзакции
+            conn.autocommit = True
+            try:
+                with conn.cursor() as cursor:
+                    cursor.execute(ddl)
+            finally:
+                conn.autocommit = False
+        logging.info('%s.%s: created index on (modified, id)', schema, table)
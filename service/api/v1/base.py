@@ -1,10 +1,76 @@
+import functools
+from http import HTTPStatus
 from typing import Optional
 
+from core.config import settings
+from fastapi import HTTPException, Query, Response
 from pydantic import BaseModel, Field
+from services.base import Service
 
 
 class SearchRequest(BaseModel):
     query: Optional[dict] = Field(title='тело запроса для эластика', default={"match_all": {}})
     sort: Optional[dict] = Field(title='Параметры сортировки')
-    page_size: Optional[int] = Field(title='размер страницы поиска', gt=1, default=5000, alias='size')
+    page_size: Optional[int] = Field(
+        title='размер страницы поиска', ge=1, le=settings.MAX_PAGE_SIZE, default=settings.PAGE_SIZE, alias='size'
+    )
     page_number: Optional[int] = Field(title='страница поиска', gt=0, default=1, alias='from')
+    cursor: Optional[str] = Field(
+        title='курсор следующей страницы; пустая строка - первая страница обхода по курсору, from не используется'
+    )
+
+    def body(self) -> dict:
+        """Тело запроса к Elasticsearch: номер страницы переводится в смещение from"""
+        if self.cursor is None and self.page_size * self.page_number > settings.MAX_RESULT_WINDOW:
+            raise HTTPException(status_code=HTTPStatus.BAD_REQUEST, detail=settings.PAGE_TOO_DEEP)
+        body = self.dict(by_alias=True, exclude_none=True, exclude={'cursor'})
+        body['from'] = (self.page_number - 1) * self.page_size
+        return body
+
+
+class CursorPage(BaseModel):
+    """Страница обхода по курсору; next_cursor пуст на последней странице"""
+    items: list
+    next_cursor: Optional[str]
+
+
+class Page(BaseModel):
+    size: int
+    number: int
+    # курсор обхода; None - постраничный режим с номером страницы
+    cursor: Optional[str]
+
+
+def get_page(
+        page_size: int = Query(
+            settings.PAGE_SIZE, alias='page[size]', title='размер страницы', ge=1, le=settings.MAX_PAGE_SIZE
+        ),
+        page_number: int = Query(1, alias='page[number]', title='номер страницы', ge=1),
+        cursor: Optional[str] = Query(
+            None, title='курсор следующей страницы; пустая строка - первая страница обхода по курсору'
+        ),
+) -> Page:
+    if cursor is None and page_size * page_number > settings.MAX_RESULT_WINDOW:
+        raise HTTPException(status_code=HTTPStatus.BAD_REQUEST, detail=settings.PAGE_TOO_DEEP)
+    return Page(size=page_size, number=page_number, cursor=cursor)
+
+
+def cached_response(func):
+    """
+    Кэширование ответа endpoint в ResponseCache сервиса. Ключ строится из параметров запроса
+    без внедренных сервисов; закэшированный ответ отдается готовыми байтами без сериализации.
+
+    Страницы обхода по курсору внутри point-in-time не кэшируются: их next_cursor ссылается
+    на point-in-time, который живет SEARCH_PIT_KEEP_ALIVE, меньше времени жизни кэша.
+    """
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        service = next(value for value in kwargs.values() if isinstance(value, Service))
+        params = {name: value for name, value in kwargs.items() if not isinstance(value, Service)}
+        if settings.SEARCH_PIT and any(getattr(value, 'cursor', None) is not None for value in params.values()):
+            payload = service.cache.dumps(await func(*args, **kwargs))
+        else:
+            payload = await service.cached(func.__name__, params, lambda: func(*args, **kwargs))
+        return Response(content=payload, media_type='application/json')
+
+    return wrapper
@@ -1,14 +1,15 @@
 from http import HTTPStatus
-from typing import List, Optional
+from typing import List, Optional, Union
 from uuid import UUID
 
 from fastapi import APIRouter, Depends, HTTPException
+from models.film import FilmShort
 from pydantic import BaseModel
 from services.films import FilmService, get_film_service
 
-from .base import SearchRequest
+from .base import (CursorPage, Page, SearchRequest, cached_response,
+                   get_page)
 from core.config import settings
-from fastapi_cache.decorator import cache
 
 router = APIRouter()
 
@@ -28,16 +29,22 @@ class FilmDetail(FilmMain):
 
 
 @router.post('/search/')
-@cache(expire=settings.CACHE_EXPIRE)
+@cached_response
 async def film_search(
         search: SearchRequest,
-        film_service: FilmService = Depends(get_film_service)) -> List[FilmMain]:
-    films_all_fields_search = await film_service.search(body=search.dict(by_alias=True))
+        film_service: FilmService = Depends(get_film_service)) -> Union[List[FilmMain], CursorPage]:
+    if search.cursor is not None:
+        films, next_cursor = await film_service.search_after(body=search.body(), cursor=search.cursor, model=FilmShort)
+        return CursorPage(
+            items=[FilmMain(uuid=x.id, title=x.title, imdb_rating=x.imdb_rating) for x in films],
+            next_cursor=next_cursor
+        )
+    films_all_fields_search = await film_service.search(body=search.body(), model=FilmShort)
     return [FilmMain(uuid=x.id, title=x.title, imdb_rating=x.imdb_rating) for x in films_all_fields_search]
 
 
 @router.get('/{film_id}', response_model=FilmDetail)
-@cache(expire=settings.CACHE_EXPIRE)
+@cached_response
 async def film_details(film_id: str, film_service: FilmService = Depends(get_film_service)) -> FilmDetail:
     film = await film_service.get(film_id)
     if not film:
@@ -48,10 +55,21 @@ async def film_details(film_id: str, film_service: FilmService = Depends(get_fil
 
 
 @router.get('/')
-@cache(expire=settings.CACHE_EXPIRE)
+@cached_response
 async def film_main(
         sort: Optional[str] = "-imdb_rating",
+        page: Page = Depends(get_page),
         film_service: FilmService = Depends(get_film_service)
-) -> List[FilmMain]:
-    films_all_fields = await film_service.get_all(sort=sort)
+) -> Union[List[FilmMain], CursorPage]:
+    if page.cursor is not None:
+        films, next_cursor = await film_service.get_all_after(
+            page_size=page.size, cursor=page.cursor, sort=sort, model=FilmShort
+        )
+        return CursorPage(
+            items=[FilmMain(uuid=x.id, title=x.title, imdb_rating=x.imdb_rating) for x in films],
+            next_cursor=next_cursor
+        )
+    films_all_fields = await film_service.get_all(
+        page_size=page.size, page_number=page.number, sort=sort, model=FilmShort
+    )
     return [FilmMain(uuid=x.id, title=x.title, imdb_rating=x.imdb_rating) for x in films_all_fields]
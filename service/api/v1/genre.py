@@ -1,14 +1,15 @@
 from http import HTTPStatus
-from typing import List, Optional
+from typing import List, Optional, Union
 from uuid import UUID
 
 from fastapi import APIRouter, Depends, HTTPException
+from models.genre import GenreShort
 from pydantic import BaseModel
 from services.genres import GenreService, get_genre_service
 
-from .base import SearchRequest
+from .base import (CursorPage, Page, SearchRequest, cached_response,
+                   get_page)
 from core.config import settings
-from fastapi_cache.decorator import cache
 
 router = APIRouter()
 
@@ -19,7 +20,7 @@ class Genre(BaseModel):
 
 
 @router.get('/{genre_id}', response_model=Genre)
-@cache(expire=settings.CACHE_EXPIRE)
+@cached_response
 async def genre_details(genre_id: str, genre_service: GenreService = Depends(get_genre_service)) -> Genre:
     genre = await genre_service.get(genre_id)
     if not genre:
@@ -29,24 +30,35 @@ async def genre_details(genre_id: str, genre_service: GenreService = Depends(get
 
 
 @router.get('/')
-@cache(expire=settings.CACHE_EXPIRE)
+@cached_response
 async def genre_main(
         sort: Optional[str] = None,
+        page: Page = Depends(get_page),
         genre_service: GenreService = Depends(get_genre_service)
-) -> List[Genre]:
-    genres = await genre_service.get_all(sort=sort)
+) -> Union[List[Genre], CursorPage]:
+    if page.cursor is not None:
+        genres, next_cursor = await genre_service.get_all_after(
+            page_size=page.size, cursor=page.cursor, sort=sort, model=GenreShort
+        )
+        return CursorPage(items=[Genre(uuid=x.id, name=x.name) for x in genres], next_cursor=next_cursor)
+    genres = await genre_service.get_all(
+        page_size=page.size, page_number=page.number, sort=sort, model=GenreShort
+    )
     if not genres:
         raise HTTPException(status_code=HTTPStatus.NOT_FOUND, detail=settings.NO_GENRES_FND)
     return [Genre(uuid=x.id, name=x.name) for x in genres]
 
 
 @router.post('/search/')
-@cache(expire=settings.CACHE_EXPIRE)
+@cached_response
 async def genre_search(
         search: SearchRequest,
         genre_service: GenreService = Depends(get_genre_service)
-) -> List[Genre]:
-    genres = await genre_service.search(body=search.dict(by_alias=True))
+) -> Union[List[Genre], CursorPage]:
+    if search.cursor is not None:
+        genres, next_cursor = await genre_service.search_after(body=search.body(), cursor=search.cursor, model=GenreShort)
+        return CursorPage(items=[Genre(uuid=x.id, name=x.name) for x in genres], next_cursor=next_cursor)
+    genres = await genre_service.search(body=search.body(), model=GenreShort)
     if not genres:
         raise HTTPException(status_code=HTTPStatus.NOT_FOUND, detail=settings.NO_GENRES_FND)
     return [Genre(uuid=x.id, name=x.name) for x in genres]
@@ -1,14 +1,15 @@
 from http import HTTPStatus
-from typing import List, Optional
+from typing import List, Optional, Union
 from uuid import UUID
 
 from fastapi import APIRouter, Depends, HTTPException
+from models.person import PersonShort
 from pydantic import BaseModel
 from services.persons import PersonService, get_person_service
 
-from .base import SearchRequest
+from .base import (CursorPage, Page, SearchRequest, cached_response,
+                   get_page)
 from core.config import settings
-from fastapi_cache.decorator import cache
 
 router = APIRouter()
 
@@ -19,16 +20,19 @@ class Person(BaseModel):
 
 
 @router.post('/search/')
-@cache(expire=settings.CACHE_EXPIRE)
+@cached_response
 async def person_search(
         search: SearchRequest,
-        person_service: PersonService = Depends(get_person_service)) -> List[Person]:
-    persons_all_fields_search = await person_service.search(body=search.dict(by_alias=True))
+        person_service: PersonService = Depends(get_person_service)) -> Union[List[Person], CursorPage]:
+    if search.cursor is not None:
+        persons, next_cursor = await person_service.search_after(body=search.body(), cursor=search.cursor, model=PersonShort)
+        return CursorPage(items=[Person(uuid=x.id, full_name=x.full_name) for x in persons], next_cursor=next_cursor)
+    persons_all_fields_search = await person_service.search(body=search.body(), model=PersonShort)
     return [Person(uuid=x.id, full_name=x.full_name) for x in persons_all_fields_search]
 
 
 @router.get('/{person_id}', response_model=Person)
-@cache(expire=settings.CACHE_EXPIRE)
+@cached_response
 async def person_details(person_id: str, person_service: PersonService = Depends(get_person_service)) -> Person:
     person = await person_service.get(person_id)
     if not person:
@@ -37,10 +41,18 @@ async def person_details(person_id: str, person_service: PersonService = Depends
 
 
 @router.get('/')
-@cache(expire=settings.CACHE_EXPIRE)
+@cached_response
 async def person_main(
         sort: Optional[str] = None,
+        page: Page = Depends(get_page),
         person_service: PersonService = Depends(get_person_service)
-) -> List[Person]:
-    persons_all_fields = await person_service.get_all(sort=sort)
-    return [Person(uuid=x.id, title=x.title, imdb_rating=x.imdb_rating) for x in persons_all_fields]
+) -> Union[List[Person], CursorPage]:
+    if page.cursor is not None:
+        persons, next_cursor = await person_service.get_all_after(
+            page_size=page.size, cursor=page.cursor, sort=sort, model=PersonShort
+        )
+        return CursorPage(items=[Person(uuid=x.id, full_name=x.full_name) for x in persons], next_cursor=next_cursor)
+    persons_all_fields = await person_service.get_all(
+        page_size=page.size, page_number=page.number, sort=sort, model=PersonShort
+    )
+    return [Person(uuid=x.id, full_name=x.full_name) for x in persons_all_fields]
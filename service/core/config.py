@@ -31,8 +31,26 @@ class Settings(BaseSettings):
     NO_GENRES_FND: str = os.getenv('NO_GENRES_FND', 'no genres found')
     NO_PERSON_FND: str = os.getenv('NO_PERSON_FND', 'person not found')
 
+    # Размер страницы списков по умолчанию и его предел
+    PAGE_SIZE: int = os.getenv('PAGE_SIZE', 50)
+    MAX_PAGE_SIZE: int = os.getenv('MAX_PAGE_SIZE', 100)
+    # Дальше index.max_result_window Elasticsearch не отдает результаты через from/size
+    MAX_RESULT_WINDOW: int = os.getenv('MAX_RESULT_WINDOW', 10000)
+    PAGE_TOO_DEEP: str = os.getenv('PAGE_TOO_DEEP', 'page is too deep, use cursor pagination')
+    BAD_CURSOR: str = os.getenv('BAD_CURSOR', 'invalid cursor')
+    # Обход по курсору внутри point-in-time (Elasticsearch 7.10+): все страницы видят один снимок индекса
+    SEARCH_PIT: bool = os.getenv('SEARCH_PIT', 'False') == 'True'
+    SEARCH_PIT_KEEP_ALIVE: str = os.getenv('SEARCH_PIT_KEEP_ALIVE', '1m')
+
     # Время жизни кэша
     CACHE_EXPIRE: int = os.getenv('CACHE_EXPIRE', 360)
+    # Кэш ответов в памяти воркера перед Redis: число записей (0 - выключен), объем в байтах и время жизни в секундах
+    CACHE_LOCAL_MAX_ENTRIES: int = os.getenv('CACHE_LOCAL_MAX_ENTRIES', 5000)
+    CACHE_LOCAL_MAX_BYTES: int = os.getenv('CACHE_LOCAL_MAX_BYTES', 64 * 1024 * 1024)
+    CACHE_LOCAL_TTL: float = os.getenv('CACHE_LOCAL_TTL', 30)
+    # Сколько миллисекунд живет блокировка вычисления холодного ключа и как часто ждущие проверяют кэш, в секундах
+    CACHE_LOCK_TIMEOUT: int = os.getenv('CACHE_LOCK_TIMEOUT', 5000)
+    CACHE_LOCK_POLL: float = os.getenv('CACHE_LOCK_POLL', 0.05)
 
     class Config:
         env_file = '.env'
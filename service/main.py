@@ -1,3 +1,4 @@
+import asyncio
 import logging
 
 import aioredis
@@ -9,15 +10,7 @@ from db import elastic, redis
 from elasticsearch import AsyncElasticsearch
 from fastapi import FastAPI
 from fastapi.responses import ORJSONResponse
-from fastapi_cache import FastAPICache
-from fastapi_cache.backends.redis import RedisBackend
-from fastapi_cache.decorator import cache
-
-
-@cache()
-async def get_cache():
-    return 1
-
+from services.base import ResponseCache
 
 app = FastAPI(
     title=settings.PROJECT_NAME,
@@ -47,12 +40,12 @@ app.include_router(
 
 @app.on_event('startup')
 async def startup():
+    # кэш хранит готовые байты ответов, поэтому без декодирования
     redis.redis = await aioredis.from_url(
-        f'redis://{settings.REDIS_HOST}:{settings.REDIS_PORT}',
-        encoding="utf-8",
-        decode_responses=True,
+        f'redis://{settings.REDIS_HOST}:{settings.REDIS_PORT}'
     )
-    FastAPICache.init(RedisBackend(redis.redis), prefix="async_api")
+    # воркеры сообщают друг другу о ключах, которые нужно убрать из кэша в памяти
+    app.state.cache_listener = asyncio.create_task(ResponseCache.listen(redis.redis))
     elastic.es = AsyncElasticsearch(
         hosts=[f'{settings.ELASTIC_HOST}:{settings.ELASTIC_PORT}']
     )
@@ -60,18 +53,24 @@ async def startup():
 
 @app.on_event('shutdown')
 async def shutdown():
+    app.state.cache_listener.cancel()
     await redis.redis.close()
     await elastic.es.close()
 
 
 @app.get('/')
-@cache(expire=60)
 async def home():
     return dict(
         service=settings.PROJECT_NAME,
     )
 
 
+@app.get('/api/v1/cache/metrics')
+async def cache_metrics():
+    metrics = ResponseCache.metrics
+    return dict(**metrics.dict(), hit_ratio=metrics.hit_ratio)
+
+
 if __name__ == '__main__':
     uvicorn.run(
         'main:app',
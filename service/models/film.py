@@ -18,3 +18,10 @@ class Film(BaseModel, BaseOrjsonModel.Config):
     writers_names: Optional[List[str]]
     directors_names: Optional[List[str]]
     actors_names: Optional[List[str]]
+
+
+class FilmShort(BaseModel, BaseOrjsonModel.Config):
+    """Поля фильма для списков и поиска"""
+    id: Optional[UUID]
+    title: Optional[str]
+    imdb_rating: Optional[float]
@@ -10,3 +10,9 @@ class Genre(BaseModel, BaseOrjsonModel.Config):
     id: UUID
     name: str
     description: Optional[str] = ''
+
+
+class GenreShort(BaseModel, BaseOrjsonModel.Config):
+    """Поля жанра для списков и поиска"""
+    id: UUID
+    name: str
@@ -11,3 +11,9 @@ class Person(BaseModel, BaseOrjsonModel.Config):
     id: UUID
     full_name: str
     birth_date: Optional[date]
+
+
+class PersonShort(BaseModel, BaseOrjsonModel.Config):
+    """Поля персоны для списков и поиска"""
+    id: UUID
+    full_name: str
@@ -1,12 +1,282 @@
+import asyncio
+import base64
+import binascii
+import hashlib
+import time
+import uuid
 from abc import ABC, abstractmethod
-from typing import Type, Union
+from collections import OrderedDict
+from http import HTTPStatus
+from typing import (Any, Awaitable, Callable, Dict, List, Optional, Tuple,
+                    Type, Union)
 
-from aioredis import Redis
-from elasticsearch import AsyncElasticsearch
-from elasticsearch.helpers import async_scan
+import orjson
+from aioredis import Redis, RedisError
+from core.config import settings
+from elasticsearch import AsyncElasticsearch, NotFoundError, RequestError
+from fastapi import HTTPException
 from models.film import Film
 from models.genre import Genre
 from models.person import Person
+from pydantic import BaseModel
+
+
+def encode_cursor(state: dict) -> str:
+    return base64.urlsafe_b64encode(orjson.dumps(state)).decode()
+
+
+def decode_cursor(cursor: str) -> dict:
+    try:
+        state = orjson.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (ValueError, binascii.Error):
+        raise HTTPException(status_code=HTTPStatus.BAD_REQUEST, detail=settings.BAD_CURSOR)
+    if not isinstance(state, dict):
+        raise HTTPException(status_code=HTTPStatus.BAD_REQUEST, detail=settings.BAD_CURSOR)
+    return state
+
+
+def with_tiebreaker(sort: Optional[Union[dict, list, str]]) -> list:
+    """Сортировка с id последним ключом: порядок однозначен, и search_after не теряет и не повторяет документы"""
+    if not sort:
+        sort = ['_score']
+    elif isinstance(sort, dict):
+        sort = [{field: order} for field, order in sort.items()]
+    elif isinstance(sort, str):
+        sort = [sort]
+    else:
+        sort = list(sort)
+    fields = {key for item in sort for key in ([item] if isinstance(item, str) else item)}
+    if 'id' not in fields:
+        sort.append({'id': 'asc'})
+    return sort
+
+
+# ошибки Redis, при которых кэш пропускается
+REDIS_ERRORS = (ConnectionError, OSError, RedisError)
+
+# удаление блокировки, только если она все еще принадлежит владельцу token: истекшую блокировку
+# мог занять другой процесс
+RELEASE_LOCK = """
+    if redis.call('get', KEYS[1]) == ARGV[1] then
+        return redis.call('del', KEYS[1])
+    end
+    return 0
+    """
+
+
+class CacheMetrics(BaseModel):
+    """Счетчики кэша ответов одного процесса"""
+    hits: int = 0
+    # попадания в кэш процесса, без обращения к Redis
+    local_hits: int = 0
+    misses: int = 0
+    # запросы, дождавшиеся значения, которое вычислял другой запрос
+    coalesced: int = 0
+    errors: int = 0
+
+    @property
+    def hit_ratio(self) -> float:
+        total = self.local_hits + self.hits + self.misses
+        return (self.local_hits + self.hits) / total if total else 0
+
+
+def _default(obj: Any) -> Any:
+    if isinstance(obj, BaseModel):
+        return obj.dict()
+    raise TypeError(f'{type(obj).__name__} is not JSON serializable')
+
+
+class LocalCache:
+    """
+    Кэш ответов в памяти процесса перед Redis: LRU с ограничением по числу записей и по объему
+    и со сроком жизни записи
+    """
+
+    def __init__(self, max_entries: int, max_bytes: int, ttl: float):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.entries: 'OrderedDict[str, Tuple[float, bytes]]' = OrderedDict()
+        self.size = 0
+
+    def get(self, key: str) -> Optional[bytes]:
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        expires, payload = entry
+        if expires < time.monotonic():
+            self.pop(key)
+            return None
+        self.entries.move_to_end(key)
+        return payload
+
+    def set(self, key: str, payload: bytes):
+        if not self.max_entries or len(payload) > self.max_bytes:
+            return
+        self.pop(key)
+        self.entries[key] = (time.monotonic() + self.ttl, payload)
+        self.size += len(payload)
+        while len(self.entries) > self.max_entries or self.size > self.max_bytes:
+            _, (_, evicted) = self.entries.popitem(last=False)
+            self.size -= len(evicted)
+
+    def pop(self, key: str):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.size -= len(entry[1])
+
+
+class ResponseCache:
+    """
+    Кэш ответов в Redis: ответ хранится готовыми байтами orjson и отдается без повторной сериализации.
+
+    Ключ строится только из нормализованных параметров запроса. Холодный ключ вычисляется один раз:
+    внутри процесса запросы ждут общую asyncio-блокировку, между процессами - блокировку SET NX в Redis;
+    остальные запросы дожидаются значения в кэше, а не идут в Elasticsearch.
+
+    Горячие ключи дополнительно хранятся в памяти процесса. Процесс, записавший ключ в Redis,
+    сообщает о нем в канал pub/sub, и остальные процессы убирают свою копию.
+    """
+
+    prefix = 'async_api'
+    channel = f'{prefix}:invalidate'
+    # отличает сообщения этого процесса от сообщений других воркеров
+    origin = uuid.uuid4().hex
+    # блокировки ключей в этом процессе, кэш процесса и счетчики общие для всех запросов
+    locks: Dict[str, asyncio.Lock] = {}
+    local = LocalCache(
+        max_entries=settings.CACHE_LOCAL_MAX_ENTRIES,
+        max_bytes=settings.CACHE_LOCAL_MAX_BYTES,
+        ttl=settings.CACHE_LOCAL_TTL
+    )
+    metrics = CacheMetrics()
+
+    def __init__(self, redis: Redis, expire: int = settings.CACHE_EXPIRE):
+        self.redis = redis
+        self.expire = expire
+
+    @classmethod
+    def key(cls, namespace: str, params: dict) -> str:
+        normalized = orjson.dumps(params, default=_default, option=orjson.OPT_SORT_KEYS)
+        return f'{cls.prefix}:{namespace}:{hashlib.sha1(normalized).hexdigest()}'
+
+    async def get_or_set(self, key: str, produce: Callable[[], Awaitable[Any]]) -> bytes:
+        cached = self.local.get(key)
+        if cached is not None:
+            self.metrics.local_hits += 1
+            return cached
+
+        cached = await self.get(key)
+        if cached is not None:
+            self.metrics.hits += 1
+            self.local.set(key, cached)
+            return cached
+
+        lock = self.locks.setdefault(key, asyncio.Lock())
+        try:
+            async with lock:
+                cached = self.local.get(key) or await self.get(key)
+                if cached is not None:
+                    self.metrics.coalesced += 1
+                    return cached
+                self.metrics.misses += 1
+                cached = await self.produce(key, produce)
+                self.local.set(key, cached)
+                return cached
+        finally:
+            if not lock.locked():
+                self.locks.pop(key, None)
+
+    async def get(self, key: str) -> Optional[bytes]:
+        """Значение из Redis; недоступный Redis - промах, и ответ вычисляется из Elasticsearch"""
+        try:
+            return await self.redis.get(key)
+        except REDIS_ERRORS:
+            self.metrics.errors += 1
+            return None
+
+    async def produce(self, key: str, produce: Callable[[], Awaitable[Any]]) -> bytes:
+        lock_key = f'{key}:lock'
+        # значение блокировки - метка владельца: снимает блокировку только тот, кто ее взял
+        token = uuid.uuid4().hex
+        try:
+            acquired = await self.redis.set(lock_key, token, nx=True, px=settings.CACHE_LOCK_TIMEOUT)
+            if not acquired:
+                cached = await self.wait(key, lock_key)
+                if cached is not None:
+                    self.metrics.coalesced += 1
+                    return cached
+        except REDIS_ERRORS:
+            # без Redis нет ни блокировки, ни общего кэша: ответ вычисляется без них
+            self.metrics.errors += 1
+            acquired = False
+        try:
+            payload = self.dumps(await produce())
+            await self.store(key, payload)
+            return payload
+        except HTTPException:
+            raise
+        except Exception:
+            self.metrics.errors += 1
+            raise
+        finally:
+            if acquired:
+                await self.release(lock_key, token)
+
+    async def wait(self, key: str, lock_key: str) -> Optional[bytes]:
+        """Значение вычисляет другой процесс: ждем его, но не дольше, чем живет его блокировка"""
+        deadline = time.monotonic() + settings.CACHE_LOCK_TIMEOUT / 1000
+        while time.monotonic() < deadline:
+            await asyncio.sleep(settings.CACHE_LOCK_POLL)
+            cached = await self.redis.get(key)
+            if cached is not None:
+                return cached
+            if not await self.redis.exists(lock_key):
+                break
+        return None
+
+    @staticmethod
+    def dumps(value: Any) -> bytes:
+        return orjson.dumps(value, default=_default)
+
+    async def store(self, key: str, payload: bytes):
+        try:
+            await self.redis.set(key, payload, ex=self.expire)
+            await self.publish(key)
+        except REDIS_ERRORS:
+            self.metrics.errors += 1
+
+    async def release(self, lock_key: str, token: str):
+        try:
+            await self.redis.eval(RELEASE_LOCK, 1, lock_key, token)
+        except REDIS_ERRORS:
+            # блокировка снимется сама по истечении CACHE_LOCK_TIMEOUT
+            self.metrics.errors += 1
+
+    async def publish(self, key: str):
+        await self.redis.publish(self.channel, f'{self.origin} {key}')
+
+    @classmethod
+    async def listen(cls, redis: Redis):
+        """Сообщения других воркеров о записанных ключах: копия ключа в памяти процесса устарела"""
+        while True:
+            pubsub = redis.pubsub()
+            try:
+                await pubsub.subscribe(cls.channel)
+                async for message in pubsub.listen():
+                    if message['type'] != 'message':
+                        continue
+                    data = message['data']
+                    origin, _, key = (data.decode() if isinstance(data, bytes) else data).partition(' ')
+                    if origin == cls.origin:
+                        continue
+                    cls.local.pop(key)
+            except REDIS_ERRORS:
+                # пропущенные сообщения не восстановить: кэш в памяти сбрасывается целиком
+                cls.local = LocalCache(cls.local.max_entries, cls.local.max_bytes, cls.local.ttl)
+                await asyncio.sleep(1)
+            finally:
+                await pubsub.close()
 
 
 class Service(ABC):
@@ -23,36 +293,111 @@ class Service(ABC):
     def __init__(self, redis: Redis, elastic: AsyncElasticsearch):
         self.redis = redis
         self.elastic = elastic
+        self.cache = ResponseCache(redis)
+
+    async def cached(self, endpoint: str, params: dict, produce: Callable[[], Awaitable[Any]]) -> bytes:
+        """Ответ endpoint из кэша: ключ - индекс, имя endpoint и параметры запроса, без объектов сервисов"""
+        return await self.cache.get_or_set(self.cache.key(f'{self.index}:{endpoint}', params), produce)
 
-    async def search(self, body):
+    @staticmethod
+    def projected(body: dict, model: Optional[Type[BaseModel]]) -> dict:
+        """Запрос только полей модели-проекции: Elasticsearch не отдает остальную часть _source"""
+        if model is None:
+            return body
+        return {**body, '_source': list(model.__fields__)}
+
+    async def search(self, body, model: Optional[Type[BaseModel]] = None):
         resp = await self.elastic.search(
             index=self.index,
-            body=body
+            body=self.projected(body, model)
         )
-        return [self.model(**doc['_source']) for doc in resp['hits']['hits']]
+        model = model or self.model
+        return [model(**doc['_source']) for doc in resp['hits']['hits']]
+
+    async def search_after(
+            self,
+            body: dict,
+            cursor: Optional[str] = None,
+            model: Optional[Type[BaseModel]] = None
+    ) -> Tuple[List, Optional[str]]:
+        """
+        Страница по курсору: следующая страница начинается после значений сортировки последнего
+        документа предыдущей (search_after), поэтому ее цена не зависит от глубины.
+        Курсор - непрозрачная строка с этими значениями и, если включено, id point-in-time.
+        """
+        state = decode_cursor(cursor) if cursor else {}
+        if not isinstance(state.get('after') or [], list) or not isinstance(state.get('pit') or '', str):
+            raise HTTPException(status_code=HTTPStatus.BAD_REQUEST, detail=settings.BAD_CURSOR)
+        body = {key: value for key, value in self.projected(body, model).items() if key != 'from'}
+        body['sort'] = with_tiebreaker(body.get('sort'))
+        if state.get('after'):
+            body['search_after'] = state['after']
+
+        pit = None
+        try:
+            if settings.SEARCH_PIT:
+                # все страницы обхода читают один снимок индекса
+                pit = state.get('pit') or (
+                    await self.elastic.open_point_in_time(index=self.index, keep_alive=settings.SEARCH_PIT_KEEP_ALIVE)
+                )['id']
+                body['pit'] = {'id': pit, 'keep_alive': settings.SEARCH_PIT_KEEP_ALIVE}
+                resp = await self.elastic.search(body=body)
+            else:
+                resp = await self.elastic.search(index=self.index, body=body)
+        except (NotFoundError, RequestError):
+            # point-in-time курсора истек или неизвестен, либо значения search_after не подходят к сортировке
+            if not state:
+                raise
+            raise HTTPException(status_code=HTTPStatus.BAD_REQUEST, detail=settings.BAD_CURSOR)
 
-    async def get_all(self, **kwargs):
-        q = {"query": {"match_all": {}}}
+        hits = resp['hits']['hits']
+        model = model or self.model
+        items = [model(**doc['_source']) for doc in hits]
+        if hits and len(hits) == body.get('size', 10):
+            return items, encode_cursor({'after': hits[-1]['sort'], 'pit': resp.get('pit_id', pit)})
+        if pit is not None:
+            await self.elastic.close_point_in_time(body={'id': resp.get('pit_id', pit)}, ignore=404)
+        return items, None
 
-        if param := kwargs.get('sort'):
+    @staticmethod
+    def list_body(page_size: int, sort: Optional[str] = None) -> dict:
+        q = {
+            "query": {"match_all": {}},
+            "size": page_size,
+        }
+
+        if param := sort:
             order_value = 'asc'
             if param.startswith('-'):
                 param = param[1:]
                 order_value = 'desc'
             q['sort'] = [{param: {'order': order_value}}]
 
-        response_list = []
+        return q
 
-        async for doc in async_scan(
-                client=self.elastic,
-                size=q.get('size', 10000),
-                index=self.index,
-                query=q,
-                preserve_order=True
-        ):
-            response_list.append(self.model(**doc['_source']))
+    async def get_all(
+            self,
+            page_size: int,
+            page_number: int = 1,
+            sort: Optional[str] = None,
+            model: Optional[Type[BaseModel]] = None
+    ):
+        """Одна страница списка: ограниченный запрос from/size вместо прокрутки всего индекса"""
+        q = self.list_body(page_size=page_size, sort=sort)
+        q['from'] = (page_number - 1) * page_size
+        return await self.search(body=q, model=model)
 
-        return response_list
+    async def get_all_after(
+            self,
+            page_size: int,
+            cursor: Optional[str] = None,
+            sort: Optional[str] = None,
+            model: Optional[Type[BaseModel]] = None
+    ):
+        """Страница списка по курсору, для обхода на любую глубину"""
+        return await self.search_after(
+            body=self.list_body(page_size=page_size, sort=sort), cursor=cursor, model=model
+        )
 
     async def get(self, id_: str):
         response = await self.elastic.get(index=self.index, id=id_)
@@ -0,0 +1,108 @@
+import datetime
+import uuid
+
+import pytest
+
+from etl_app.transfer.elastic import BulkError, BulkStats
+from etl_app.transfer.manager import Manager
+from etl_app.transfer.state import JsonFileStorage, State
+from etl_app.transfer.strategy import (ContentTableStrategyFabric,
+                                      FilmWorkTableStrategyFabric,
+                                      GenreTableStrategyFabric,
+                                      PersonTableStrategyFabric)
+
+
+@pytest.fixture
+def state(tmp_path):
+    return State(JsonFileStorage(str(tmp_path / 'state.json')))
+
+
+def film_rows(count: int, modified: datetime.datetime):
+    return [
+        {
+            'id': str(uuid.uuid4()),
+            'imdb_rating': 7.5,
+            'title': f'Film {i}',
+            'description': None,
+            'modified': modified,
+        }
+        for i in range(count)
+    ]
+
+
+def test_failed_bulk_keeps_watermark(monkeypatch, state):
+    # backoff без повторов: ошибка загрузки доходит до теста
+    monkeypatch.setenv('DEBUG', 'True')
+    date_start = datetime.datetime(2021, 1, 1)
+    saved = {'date_start': date_start.isoformat(), 'position': None}
+    state.set_state(FilmWorkTableStrategyFabric.__name__, saved)
+
+    monkeypatch.setattr(
+        FilmWorkTableStrategyFabric, 'extract',
+        lambda self, **kwargs: film_rows(3, modified=date_start + datetime.timedelta(hours=1))
+    )
+    monkeypatch.setattr(FilmWorkTableStrategyFabric, 'load', lambda self, qs: BulkStats(indexed=2, failed=1))
+
+    manager = Manager(chain=(FilmWorkTableStrategyFabric,), state=state)
+    with pytest.raises(BulkError):
+        manager.start(
+            reference_date_start=date_start,
+            reference_date_end=date_start + datetime.timedelta(days=1),
+            query_limit=3
+        )
+
+    assert state.get_state(FilmWorkTableStrategyFabric.__name__) == saved
+    assert manager.position is None
+
+
+def test_successful_bulk_advances_watermark(monkeypatch, state):
+    monkeypatch.setenv('DEBUG', 'True')
+    date_start = datetime.datetime(2021, 1, 1)
+    rows = film_rows(3, modified=date_start + datetime.timedelta(hours=1))
+    monkeypatch.setattr(FilmWorkTableStrategyFabric, 'extract', lambda self, **kwargs: rows)
+    monkeypatch.setattr(FilmWorkTableStrategyFabric, 'load', lambda self, qs: BulkStats(indexed=3))
+
+    manager = Manager(chain=(FilmWorkTableStrategyFabric,), state=state)
+    manager.start(
+        reference_date_start=date_start,
+        reference_date_end=date_start + datetime.timedelta(days=1),
+        query_limit=3
+    )
+
+    watermark = state.get_state(FilmWorkTableStrategyFabric.__name__)
+    assert watermark['position']['id'] == rows[-1]['id']
+
+
+def test_deleted_film_stays_deleted_after_chain(monkeypatch):
+    monkeypatch.setenv('DEBUG', 'True')
+    film_id = str(uuid.uuid4())
+    index = {film_id: {'id': film_id, 'title': 'Film', 'genre': ['Drama']}}
+
+    def load(self, qs, skip_unchanged=True):
+        # частичные документы записываются как doc_as_upsert
+        for doc in qs:
+            index.setdefault(doc['id'], {}).update(doc)
+        return BulkStats(indexed=len(qs))
+
+    def delete(self, ids):
+        for id_ in ids:
+            index.pop(id_, None)
+        return BulkStats(indexed=len(ids))
+
+    # жанры и участники удаленного фильма еще находятся запросами этих стратегий
+    rows = {
+        FilmWorkTableStrategyFabric: [],
+        GenreTableStrategyFabric: [{'id': film_id, 'genre': ['Drama', 'Comedy']}],
+        PersonTableStrategyFabric: [{'id': film_id, 'persons': []}],
+    }
+    monkeypatch.setattr(ContentTableStrategyFabric, 'affected_ids', lambda self, changes: {film_id})
+    monkeypatch.setattr(ContentTableStrategyFabric, 'missing_ids', lambda self, ids: list(ids))
+    monkeypatch.setattr(ContentTableStrategyFabric, 'extract_ids', lambda self, ids: rows[type(self)])
+    monkeypatch.setattr(ContentTableStrategyFabric, 'transform', lambda self, qs: list(qs))
+    monkeypatch.setattr(ContentTableStrategyFabric, 'load', load)
+    monkeypatch.setattr(ContentTableStrategyFabric, 'delete', delete)
+
+    manager = Manager(chain=(FilmWorkTableStrategyFabric, GenreTableStrategyFabric, PersonTableStrategyFabric))
+    manager.reindex({'film_work': {film_id}}, query_limit=10)
+
+    assert film_id not in index